@@ -0,0 +1 @@
+"""Benchmarks of the index, prizian and serving code (see run.py)."""
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+"""
+Checks that update_index.ScriptTagFilter, fed with chunks of random sizes,
+produces the same files as the whole-file regex of filter_out_script_tag,
+and compares their speed.
+
+    python3 benchmarks/bench_filter.py [--files 300] [--seed 0]
+"""
+
+import io
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from update_index import *
+
+
+FRAGMENTS = [b"<p>text</p>", b"\n", b"\r\n", b"<script", b"<script src='main.js'>", b"</script>",
+             b"main.js", b"<script>var a = 1;</script>", b"<scr", b"ipt", b" ", b"\xff\xfe", b"<"]
+
+
+def make_file(r):
+    kind = r.random()
+    if kind < 0.1:
+        # Binary file, as an image
+        return bytes(r.getrandbits(8) for _ in range(r.randint(0, 20000)))
+    parts = r.choices(FRAGMENTS, k=r.randint(0, 400))
+    if kind < 0.2:
+        # Minified page: a single long line
+        parts = [p for p in parts if p not in (b"\n", b"\r\n")]
+    return b"".join(parts)
+
+
+def stream(data, r, max_line):
+    out = io.BytesIO()
+    out.close = lambda: None
+    script_filter = ScriptTagFilter(out, max_line=max_line)
+    pos = 0
+    while pos < len(data):
+        size = r.randint(1, 4096)
+        script_filter.write(data[pos:pos+size])
+        pos += size
+    script_filter.close()
+    return out.getvalue(), script_filter.overflow
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    r = random.Random(args.seed)
+    corpus = [make_file(r) for _ in range(args.files)]
+
+    mismatches = overflows = 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, "page.html")
+        t_old = t_new = 0
+        for data in corpus:
+            with open(filename, "wb") as f:
+                f.write(data)
+            t0 = time.perf_counter()
+            filter_out_script_tag(filename)
+            t_old += time.perf_counter() - t0
+            with open(filename, "rb") as f:
+                expected = f.read()
+
+            max_line = r.choice([16, 256, 1024*1024])
+            t0 = time.perf_counter()
+            result, overflow = stream(data, r, max_line)
+            t_new += time.perf_counter() - t0
+            if overflow:
+                overflows += 1
+                with open(filename, "wb") as f:
+                    f.write(result)
+                filter_out_script_tag(filename)
+                with open(filename, "rb") as f:
+                    result = f.read()
+
+            if result != expected:
+                mismatches += 1
+                print("Mismatch:", data[:200])
+
+    print("{} files, {} mismatches, {} overflows".format(len(corpus), mismatches, overflows))
+    # The streaming filter runs while the upload is written anyway,
+    # filter_out_script_tag reads the saved file back and rewrites it
+    print("  extra pass after saving (read, regex, rewrite): {:8.1f} ms".format(t_old * 1000))
+    print("  filtering while writing (in memory):            {:8.1f} ms".format(t_new * 1000))
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+"""
+Compares the single-pass analyzer of update_index.parse_html_file with the
+former implementation (one regex scan per metric) on a synthetic corpus.
+
+    python3 benchmarks/bench_parse.py [--pages 300] [--repeat 5] [--seed 0]
+                                      [--pathological 0.1]
+
+Both implementations must return the same dict for every page.
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from update_index import *
+from benchmarks.corpus import make_corpus
+
+
+def parse_html_file_regex(filename):
+    """ Former implementation of parse_html_file, kept as a reference """
+    d = dict()
+    d["filename"] = filename
+    d["group"] = filename.split(os.path.sep)[1]
+
+    try:
+        with open(filename, "r", encoding="utf-8") as f:
+            text = f.read().strip()
+    except UnicodeDecodeError:
+        with open(filename, "r", encoding="latin-1") as f:
+            text = f.read().strip()
+
+    d["doctype"] = True if re.search(r"^<!DOCTYPE html>", text) else False
+    d["html_tags"] = True if re.search(r"<html>.*</html>", text, flags=re.DOTALL) else False
+    d["head_tags"] = True if re.search(r"<head>.*</head>", text, flags=re.DOTALL) else False
+    d["body_tags"] = True if re.search(r"<body.*>.*</body>", text, flags=re.DOTALL) else False
+
+    m = re.findall(pattern_title, text, re.UNICODE)
+    d["title"] = m[0].strip() if len(m) > 0 else None
+
+    m = re.findall(pattern_author, text)
+    if len(m) > 0:
+        d["author"] = tuple(sorted([n.strip().capitalize() for n in m[0].split('&')]))
+    else:
+        d["author"] = None
+
+    m = re.findall(pattern_p, text)
+    d["number_p"] = len(m)
+    d["number_words"] = 0
+    for p in m:
+        d["number_words"] += len(p.split())
+
+    d["number_img"] = len(re.findall(pattern_img, text))
+    d["number_a"] = len(re.findall(pattern_a, text))
+
+    return d
+
+
+def best_time(function, files, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for f in files:
+            function(f)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--pathological", type=float, default=0.1,
+                        help="fraction of pages with a long line of unclosed tags")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        files = make_corpus(ROOT_FOLDER, args.pages, args.seed, args.pathological)
+
+        mismatches = 0
+        for f in files:
+            old, new = parse_html_file_regex(f), parse_html_file(f)
+            if old != new:
+                mismatches += 1
+                print("Mismatch:", f)
+                print("  regex:      ", old)
+                print("  single-pass:", new)
+
+        t_old = best_time(parse_html_file_regex, files, args.repeat)
+        t_new = best_time(parse_html_file, files, args.repeat)
+
+    print("{} pages, best of {} runs".format(len(files), args.repeat))
+    print("  regex scans: {:8.1f} ms".format(t_old * 1000))
+    print("  single pass: {:8.1f} ms  (x{:.2f})".format(t_new * 1000, t_old / t_new))
+    sys.exit(1 if mismatches else 0)
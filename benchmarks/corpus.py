@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+"""
+Synthetic ROOT_FOLDER trees: groups of student pages with authors, titles,
+paragraphs, images, links, latin-1 or utf-8 encodings and, for some pages,
+long lines of unclosed tags as in minified or broken pages.
+
+    python3 -m benchmarks.corpus DIRECTORY [--groups 7] [--pages 40] ...
+"""
+
+import os
+import sys
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from update_index import *
+
+
+NAMES = ["anna", "yann", "loeiz", "mari", "soazig", "erwan", "nolwenn", "tangi", "katell", "ewen"]
+WORDS = ["brezhoneg", "skol", "lise", "pajenn", "levr", "mor", "enez", "kador", "taol", "kêr", "Ã©tÃ©"]
+
+BLOCKS = [
+    lambda r: "<p>{}</p>".format(" ".join(r.choices(WORDS, k=r.randint(1, 60)))),
+    lambda r: "<p>{} <a href=\"https://br.wikipedia.org/\">liamm</a> {}</p>".format(r.choice(WORDS), r.choice(WORDS)),
+    lambda r: "<p>unan</p><p>daou tri</p><img src='skeudenn.png'>",
+    lambda r: "<h2>{}</h2>\n<img\nsrc='{}.jpg' alt=\"\">".format(r.choice(WORDS), r.randint(0, 99)),
+    lambda r: "<p>war\nmeur a linenn</p>",
+    lambda r: "<a href=\"a.html\" class=\"b\">a</a> <a  href=\"b.html\">b</a> <a href=c>c</a>",
+    lambda r: "<script src='main.js'></script><p>goude</p>",
+    lambda r: "<div>" + "<p>" * r.randint(1, 3) + " ".join(r.choices(WORDS, k=500)) + "</p>" * r.randint(0, 2) + "</div>",
+    lambda r: "<ul>" + "".join("<li><a href=\"#{0}\">{0}</a></li>".format(i) for i in range(r.randint(1, 30))) + "</ul>",
+]
+
+# Long lines with unclosed tags, as in minified or broken pages
+PATHOLOGICAL = [
+    lambda r: " ".join("<a href=\"{0}.html\">{0}".format(i) for i in range(r.randint(20, 60))),
+    lambda r: " ".join("<p>" + r.choice(WORDS) for _ in range(r.randint(20, 60))),
+    lambda r: "".join("<img src=\"{}.png\"".format(i) for i in range(r.randint(20, 60))),
+]
+
+
+def make_page(r, i, pathological=0.1, authors=None, blocks=40, author_rate=0.8):
+    """
+    Returns the text of a page. authors is a list of names (default: 1 to 3
+    random names), blocks the maximum number of paragraphs, lists...
+    """
+    parts = []
+    if r.random() < 0.8:
+        parts.append("<!DOCTYPE html>")
+    parts.append("<html>" if r.random() < 0.9 else "<HTML lang=\"br\">")
+    parts.append("<head>" if r.random() < 0.9 else "<header>")
+    if r.random() < 0.85:
+        parts.append("<title> Pajenn {} </title>".format(i))
+    if authors is None:
+        authors = r.sample(NAMES, r.randint(1, 3))
+    authors = " & ".join(authors)
+    if r.random() < 0.75 * author_rate:
+        parts.append("<meta name=\"author\" content=\"{}\">".format(authors))
+    elif r.random() < 0.25 * author_rate / (1 - 0.75 * author_rate):
+        parts.append("<meta\n  name = \"author\"\n  content=\"{}\" >".format(authors))
+    parts.append("</head>")
+    parts.append("<body>" if r.random() < 0.5 else "<body style=\"color:red\">")
+    for _ in range(r.randint(0, blocks)):
+        parts.append(r.choice(BLOCKS)(r))
+    if r.random() < pathological:
+        parts.append(r.choice(PATHOLOGICAL)(r))
+    parts.append("</body>")
+    if r.random() < 0.9:
+        parts.append("</html>")
+    sep = "\r\n" if r.random() < 0.1 else "\n"
+    return sep.join(parts)
+
+
+def write_page_file(filename, text, r):
+    encoding = "latin-1" if r.random() < 0.2 else "utf-8"
+    with open(filename, "wb") as f:
+        f.write(text.encode(encoding, errors="replace"))
+
+
+def make_corpus(root, n_pages, seed, pathological=0.1):
+    "n_pages pages with random authors, spread over the groups of UPLOAD_SERVERS."
+    r = random.Random(seed)
+    groups = sorted(UPLOAD_SERVERS)
+    for g in groups:
+        os.makedirs(os.path.join(root, g), exist_ok=True)
+    files = []
+    for i in range(n_pages):
+        filename = os.path.join(root, r.choice(groups), "pajenn{}.html".format(i))
+        write_page_file(filename, make_page(r, i, pathological), r)
+        files.append(filename)
+    return files
+
+
+def group_names(n_groups):
+    "The groups of UPLOAD_SERVERS first, then made up ones."
+    names = sorted(UPLOAD_SERVERS)[:n_groups]
+    names += ["strollad{}".format(i) for i in range(len(names), n_groups)]
+    return names
+
+
+def make_tree(root, n_groups=7, pages=40, blocks=40, pathological=0.05,
+              images=0.5, author_rate=0.95, seed=0):
+    """
+    Writes a tree of n_groups groups of `pages` pages each, as students
+    would: pairs or trios of students of the group writing a page, most
+    of them with their names in the author tag, images next to the pages.
+    Returns the list of html files.
+    """
+    r = random.Random(seed)
+    files = []
+    for g in group_names(n_groups):
+        directory = os.path.join(root, g)
+        os.makedirs(directory, exist_ok=True)
+        students = ["{}{}".format(r.choice(NAMES), k) for k in range(pages * 2)]
+        r.shuffle(students)
+        for i in range(pages):
+            authors = students[2*i:2*i + r.randint(1, 3)] or [r.choice(students)]
+            filename = os.path.join(directory, "pajenn{}.html".format(i))
+            write_page_file(filename, make_page(r, i, pathological, authors, blocks, author_rate), r)
+            files.append(filename)
+            if r.random() < images:
+                with open(os.path.join(directory, "skeudenn{}.png".format(i)), "wb") as f:
+                    f.write(b"\x89PNG\r\n\x1a\n" + r.randbytes(r.randint(1000, 50000)))
+    return files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes a synthetic tree of student pages")
+    parser.add_argument("directory", help="where ROOT_FOLDER is created")
+    parser.add_argument("--groups", type=int, default=7)
+    parser.add_argument("--pages", type=int, default=40, help="pages per group")
+    parser.add_argument("--blocks", type=int, default=40,
+                        help="maximum number of paragraphs, lists... per page")
+    parser.add_argument("--pathological", type=float, default=0.05,
+                        help="fraction of pages with a long line of unclosed tags")
+    parser.add_argument("--images", type=float, default=0.5,
+                        help="fraction of pages with an image file")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    files = make_tree(os.path.join(args.directory, ROOT_FOLDER), args.groups, args.pages,
+                      args.blocks, args.pathological, args.images, seed=args.seed)
+    print("{} pages written in {}".format(len(files), os.path.join(args.directory, ROOT_FOLDER)))
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+"""
+Times each stage of the index and prizian pipeline on a synthetic tree
+(see corpus.py), and compares the results with a baseline.
+
+    python3 -m benchmarks.run [--groups 7] [--pages 40] [--blocks 40]
+                              [--repeat 5] [--jobs 4] [--output results.json]
+                              [--baseline baseline.json] [--tolerance 0.25]
+
+--tree DIRECTORY times a copy of an existing tree (DIRECTORY/ROOT_FOLDER
+and NOTES_FILE) instead.
+Exits with status 1 when a stage is slower than the baseline by more than
+the tolerance.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import update_index
+from update_index import *
+import prizian
+from benchmarks.corpus import make_tree, group_names
+
+
+RESULTS_VERSION = 1
+
+
+def stage_list_files(ctx):
+    ctx["files"] = [f for f in list_files_in(ROOT_FOLDER) if is_html(f)]
+
+
+def stage_snapshot(ctx):
+    snapshot_tree(ROOT_FOLDER)
+
+
+def stage_parse(ctx):
+    ctx["pages"] = parse_pages(ctx["files"])
+
+
+def stage_parse_parallel(ctx):
+    parse_pages(ctx["files"], ctx["jobs"])
+
+
+def stage_index_cold(ctx):
+    if os.path.exists(CACHE_FILE):
+        os.remove(CACHE_FILE)
+    # Nor the group columns kept by the renderer
+    update_index.INDEX_RENDERER = IndexRenderer()
+    with contextlib.redirect_stdout(io.StringIO()):
+        update_index_page(ctx["jobs"])
+
+
+def stage_index_warm(ctx):
+    with contextlib.redirect_stdout(io.StringIO()):
+        update_index_page(ctx["jobs"])
+
+
+def stage_prizian_assign(ctx):
+    pages = [p for p in ctx["pages"] if p["author"] is not None]
+    strolladou = prizian.get_strolladou(pages)
+    liseidi = prizian.get_liseidi(strolladou)
+    ctx["prizian"] = prizian.prizian(strolladou, liseidi, seed=0)
+
+
+def stage_prizian_render(ctx):
+    prizi_anv, prizi_strollad = ctx["prizian"]
+    prizian.dre_anv_html(prizi_anv)
+    prizian.dre_strollad_html(prizi_strollad)
+
+
+# In order: a stage may use what the previous ones put in ctx
+STAGES = [
+    ("list_files_in", stage_list_files),
+    ("snapshot_tree", stage_snapshot),
+    ("parse_pages", stage_parse),
+    ("parse_pages_parallel", stage_parse_parallel),
+    ("update_index_page_cold", stage_index_cold),
+    ("update_index_page_warm", stage_index_warm),
+    ("prizian_assign", stage_prizian_assign),
+    ("prizian_render", stage_prizian_render),
+]
+
+
+def run_stages(repeat, jobs, only=None):
+    ctx = {"jobs": jobs}
+    results = {}
+    for name, stage in STAGES:
+        if name == "parse_pages_parallel" and jobs == 1:
+            continue
+        runs = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            stage(ctx)
+            runs.append(time.perf_counter() - t0)
+        if only is None or name in only:
+            results[name] = {"runs": runs, "best": min(runs), "median": statistics.median(runs)}
+    return results
+
+
+def compare(results, baseline, tolerance):
+    "Prints the results next to the baseline, returns the slower stages."
+    if baseline["params"] != results["params"]:
+        print("Warning: the baseline was measured with other parameters:", baseline["params"])
+    regressions = []
+    print("{:<26} {:>12} {:>12} {:>8}".format("stage (median)", "baseline", "now", "ratio"))
+    for name, stage in results["stages"].items():
+        if name not in baseline["stages"]:
+            print("{:<26} {:>12} {:>10.1f}ms".format(name, "-", stage["median"] * 1000))
+            continue
+        before = baseline["stages"][name]["median"]
+        ratio = stage["median"] / before if before else float("inf")
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = "  SLOWER"
+            regressions.append(name)
+        elif ratio < 1 / (1 + tolerance):
+            flag = "  faster"
+        print("{:<26} {:>10.1f}ms {:>10.1f}ms {:>7.2f}x{}".format(
+            name, before * 1000, stage["median"] * 1000, ratio, flag))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the index and prizian pipeline")
+    parser.add_argument("--groups", type=int, default=7)
+    parser.add_argument("--pages", type=int, default=40, help="pages per group")
+    parser.add_argument("--blocks", type=int, default=40,
+                        help="maximum number of paragraphs, lists... per page")
+    parser.add_argument("--pathological", type=float, default=0.05,
+                        help="fraction of pages with a long line of unclosed tags")
+    parser.add_argument("--images", type=float, default=0.5,
+                        help="fraction of pages with an image file")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tree", default=None,
+                        help="time an existing tree instead of a synthetic one")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="processes parsing the pages (0: one per CPU)")
+    parser.add_argument("--stages", default=None,
+                        help="comma separated stages to report (default: all)")
+    parser.add_argument("-o", "--output", default=None, help="write the results to this JSON file")
+    parser.add_argument("--baseline", default=None, help="JSON results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="slowdown ratio above which a stage is reported as slower")
+    args = parser.parse_args()
+
+    params = {k: getattr(args, k) for k in ("groups", "pages", "blocks", "pathological",
+                                            "images", "seed", "repeat", "jobs")}
+    only = set(args.stages.split(",")) if args.stages else None
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    if args.baseline:
+        args.baseline = os.path.abspath(args.baseline)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.tree:
+            params = {"tree": os.path.abspath(args.tree), "repeat": args.repeat, "jobs": args.jobs}
+            shutil.copytree(os.path.join(args.tree, ROOT_FOLDER), os.path.join(tmp_dir, ROOT_FOLDER))
+            if os.path.exists(os.path.join(args.tree, NOTES_FILE)):
+                shutil.copy(os.path.join(args.tree, NOTES_FILE), tmp_dir)
+            os.chdir(tmp_dir)
+        else:
+            os.chdir(tmp_dir)
+            make_tree(ROOT_FOLDER, args.groups, args.pages, args.blocks,
+                      args.pathological, args.images, seed=args.seed)
+            # Ports of the made up groups, for the upload links of the index
+            for i, g in enumerate(group_names(args.groups)):
+                update_index.UPLOAD_SERVERS.setdefault(g, str(9000 + i))
+        stages = run_stages(args.repeat, args.jobs, only)
+
+    results = {
+        "version": RESULTS_VERSION,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "params": params,
+        "stages": stages,
+    }
+    for name, stage in stages.items():
+        print("{:<26} best {:>9.1f} ms   median {:>9.1f} ms".format(
+            name, stage["best"] * 1000, stage["median"] * 1000))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Results written to", args.output)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print()
+        regressions = compare(results, baseline, args.tolerance)
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+"""
+SQLite catalog of the pages of ROOT_FOLDER and of the notes of NOTES_FILE,
+shared by update_index.py, prizian.py and droopy.py (--catalog option).
+
+The catalog is brought up to date by sync(): only new or modified files
+are parsed, in a single transaction. The database is in WAL mode, so
+that readers are not blocked while it is updated.
+
+    python3 catalog.py [--sync] [--author NAME] [--missing-author]
+"""
+
+import json
+import sqlite3
+import hashlib
+import argparse
+
+from update_index import (ROOT_FOLDER, NOTES_FILE, CATALOG_FILE, list_files_in, is_html,
+                          parse_pages, file_signature, parse_evezhiadennou)
+import profiling
+
+
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    path TEXT PRIMARY KEY,
+    grp TEXT NOT NULL,
+    title TEXT,
+    -- Authors joined by " & ", NULL without author tag
+    authors TEXT,
+    doctype INTEGER NOT NULL,
+    html_tags INTEGER NOT NULL,
+    head_tags INTEGER NOT NULL,
+    body_tags INTEGER NOT NULL,
+    number_p INTEGER NOT NULL,
+    number_words INTEGER NOT NULL,
+    number_img INTEGER NOT NULL,
+    number_a INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pages_grp ON pages (grp);
+CREATE INDEX IF NOT EXISTS pages_authors ON pages (authors);
+CREATE INDEX IF NOT EXISTS pages_missing_author ON pages (grp) WHERE authors IS NULL;
+
+-- One row per author of a page
+CREATE TABLE IF NOT EXISTS page_authors (
+    path TEXT NOT NULL REFERENCES pages (path) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    PRIMARY KEY (path, name)
+);
+CREATE INDEX IF NOT EXISTS page_authors_name ON page_authors (name);
+
+CREATE TABLE IF NOT EXISTS notes (
+    authors TEXT PRIMARY KEY,
+    note TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+PAGE_COLUMNS = ("path", "grp", "title", "authors", "doctype", "html_tags", "head_tags", "body_tags",
+                "number_p", "number_words", "number_img", "number_a")
+
+
+def authors_key(author):
+    return " & ".join(author) if author else None
+
+
+def authors_tuple(key):
+    return tuple(key.split(" & ")) if key is not None else None
+
+
+def file_hash(filename):
+    with open(filename, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def row_to_page(row):
+    "Returns the dict of parse_html_file, keys in the same order."
+    return {
+        "filename": row[0],
+        "group": row[1],
+        "doctype": bool(row[4]),
+        "html_tags": bool(row[5]),
+        "head_tags": bool(row[6]),
+        "body_tags": bool(row[7]),
+        "title": row[2],
+        "author": authors_tuple(row[3]),
+        "number_p": row[8],
+        "number_words": row[9],
+        "number_img": row[10],
+        "number_a": row[11],
+    }
+
+
+class Catalog(object):
+    """
+    Connection to the catalog. A connection must only be used by the
+    thread that opened it.
+    """
+
+    def __init__(self, filename=CATALOG_FILE):
+        self.filename = filename
+        self.db = sqlite3.connect(filename, timeout=30, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA foreign_keys=ON")
+        version = self._schema_version()
+        if version not in (None, SCHEMA_VERSION):
+            raise ValueError("{}: unknown catalog version {}".format(filename, version))
+        if version is None:
+            self.db.executescript(SCHEMA)
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (str(SCHEMA_VERSION),))
+
+    def _schema_version(self):
+        try:
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return int(row[0]) if row else None
+
+    def close(self):
+        self.db.close()
+
+    def transaction(self):
+        return Transaction(self.db)
+
+    def sync(self, files, jobs=1, snapshot=None, profiler=profiling.NULL_PROFILER):
+        """
+        Updates the pages of the catalog to match files (parsing the new or
+        modified ones) and returns them, as parse_pages would.
+        Signatures are taken from the snapshot (see snapshot_tree) when one is given.
+        """
+        known = dict()
+        for path, ino, size, mtime_ns in self.db.execute("SELECT path, ino, size, mtime_ns FROM pages"):
+            known[path] = [ino, size, mtime_ns]
+
+        to_parse = []
+        signatures = dict()
+        for f in files:
+            signature = snapshot[f] if snapshot else file_signature(f)
+            if known.get(f) != signature:
+                to_parse.append(f)
+                signatures[f] = signature
+
+        parsed = parse_pages(to_parse, jobs, profiler)
+        removed = set(known).difference(files)
+        if parsed or removed:
+            with self.transaction():
+                for page in parsed:
+                    self._store_page(page, signatures[page["filename"]])
+                self.db.executemany("DELETE FROM pages WHERE path = ?", [(f,) for f in removed])
+        return self.pages(files)
+
+    def _store_page(self, page, signature):
+        path = page["filename"]
+        self.db.execute("DELETE FROM pages WHERE path = ?", (path,))
+        self.db.execute(
+            "INSERT INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (path, page["group"], page["title"], authors_key(page["author"]),
+             page["doctype"], page["html_tags"], page["head_tags"], page["body_tags"],
+             page["number_p"], page["number_words"], page["number_img"], page["number_a"],
+             signature[0], signature[1], signature[2], file_hash(path)))
+        if page["author"]:
+            self.db.executemany("INSERT OR IGNORE INTO page_authors VALUES (?, ?)",
+                                [(path, name) for name in page["author"]])
+
+    def pages(self, files=None):
+        "The pages of files (default: all of them, sorted by path)."
+        query = "SELECT {} FROM pages".format(", ".join(PAGE_COLUMNS))
+        if files is None:
+            return [row_to_page(row) for row in self.db.execute(query + " ORDER BY path")]
+        by_path = dict()
+        for row in self.db.execute(query):
+            by_path[row[0]] = row
+        return [row_to_page(by_path[f]) for f in files]
+
+    def sync_notes(self):
+        "Reads NOTES_FILE again if it has changed."
+        try:
+            signature = json.dumps(file_signature(NOTES_FILE))
+        except OSError:
+            signature = None
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'notes'").fetchone()
+        if row is not None and row[0] == signature:
+            return
+        notes = parse_evezhiadennou()
+        with self.transaction():
+            self.db.execute("DELETE FROM notes")
+            self.db.executemany("INSERT INTO notes VALUES (?, ?)",
+                                [(authors_key(a), n) for a, n in notes.items()])
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('notes', ?)", (signature,))
+
+    def notes(self):
+        "Same as parse_evezhiadennou."
+        return {authors_tuple(a): n for a, n in self.db.execute("SELECT authors, note FROM notes")}
+
+    def pages_by_author(self, name):
+        query = "SELECT {} FROM pages JOIN page_authors USING (path) WHERE name = ? ORDER BY path"
+        return [row_to_page(row) for row in self.db.execute(
+            query.format(", ".join("pages." + c for c in PAGE_COLUMNS)), (name.strip().capitalize(),))]
+
+    def pages_missing_author(self, group=None):
+        query = "SELECT {} FROM pages WHERE authors IS NULL".format(", ".join(PAGE_COLUMNS))
+        if group is None:
+            return [row_to_page(row) for row in self.db.execute(query + " ORDER BY grp, path")]
+        return [row_to_page(row) for row in self.db.execute(query + " AND grp = ? ORDER BY path", (group,))]
+
+    def groups_missing_author(self):
+        "Returns {group: number of pages without author tag}."
+        return dict(self.db.execute(
+            "SELECT grp, count(*) FROM pages WHERE authors IS NULL GROUP BY grp ORDER BY grp"))
+
+
+class Transaction(object):
+    "Context manager: BEGIN IMMEDIATE, then COMMIT or ROLLBACK."
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Queries the page catalog")
+    parser.add_argument("--catalog", default=CATALOG_FILE)
+    parser.add_argument("--sync", action="store_true", default=False,
+                        help="bring the catalog up to date first")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes parsing the pages (0: one per CPU)")
+    parser.add_argument("--author", default=None, help="list the pages of this author")
+    parser.add_argument("--missing-author", action="store_true", default=False,
+                        help="list the pages without author tag, by group")
+    args = parser.parse_args()
+
+    catalog = Catalog(args.catalog)
+    if args.sync:
+        catalog.sync([f for f in list_files_in(ROOT_FOLDER) if is_html(f)], args.jobs)
+        catalog.sync_notes()
+    if args.author:
+        for page in catalog.pages_by_author(args.author):
+            print(page["filename"], "-", page["title"])
+    if args.missing_author:
+        for page in catalog.pages_missing_author():
+            print(page["filename"], "-", page["title"])
+        for group, count in catalog.groups_missing_author().items():
+            print("{}: {} page(s) without author".format(group, count))
+    catalog.close()
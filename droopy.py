@@ -19,20 +19,43 @@ else:
     import SocketServer as socketserver
     import urllib as urllibparse
 
-import cgi
 import os
 import posixpath
-import macpath
+try:
+    import macpath
+except ImportError:
+    # Removed in Python 3.8
+    macpath = None
 import ntpath
 import argparse
 import mimetypes
-import shutil
+import stat
 import tempfile
 import socket
 import base64
+import binascii
+import hashlib
+import re
 import functools
+import threading
+import time
+import email.message
+import email.utils
 
 from update_index import *
+### ADDED
+from httpfiles import FileSenderMixin
+import metrics
+
+REQUESTS = metrics.Counter("droopy_http_requests_total", "HTTP requests", ["method", "code"])
+RECEIVED_BYTES = metrics.Counter("droopy_received_bytes_total", "Bytes of upload request bodies read")
+SENT_BYTES = metrics.Counter("droopy_sent_bytes_total", "Bytes of response bodies sent")
+UPLOAD_SECONDS = metrics.Histogram("droopy_upload_duration_seconds", "Duration of upload requests",
+                                   buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+ACTIVE_CONNECTIONS = metrics.Gauge("droopy_active_connections", "Open client connections")
+UPLOADED_FILES = metrics.Counter("droopy_uploaded_files_total",
+                                 "Uploaded files: stored, linked to an identical file of the blob store, "
+                                 "or identical to the file already there", ["result"])
 
 
 def _decode_str_if_py2(inputstr, encoding='utf-8'):
@@ -56,7 +79,8 @@ def fullpath(path):
 def basename(path):
     "Extract the file base name (some browsers send the full file path)."
     for mod in posixpath, macpath, ntpath:
-        path = mod.basename(path)
+        if mod is not None:
+            path = mod.basename(path)
     return path
 
 def check_auth(method):
@@ -69,9 +93,13 @@ def check_auth(method):
             expected = 'Basic ' + base64.b64encode(self.auth)
             # TODO: Timing attack?
             if received != expected:
+                if self.command == 'POST':
+                    # The upload won't be read
+                    self.close_after_response()
                 self.send_response(401)
                 self.send_header('WWW-Authenticate', 'Basic realm=\"Droopy\"')
                 self.send_header('Content-type', 'text/html')
+                self.send_header('Content-Length', '0')
                 self.end_headers()
             else:
                 method(self, *pargs)
@@ -85,53 +113,467 @@ class Abort(Exception):
     "Used by handle to rethrow exceptions in ThreadedHTTPServer."
 
 
-class DroopyFieldStorage(cgi.FieldStorage):
+TMPPREFIX = 'tmpdroopy'
+
+
+class UploadError(Exception):
+    "Raised by MultipartParser, code is the HTTP status to answer with."
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+class UploadedFile(object):
+    "A file part of the form, saved under tmpfilename."
+
+    def __init__(self, filename, tmpfilename):
+        self.filename = filename
+        self.tmpfilename = tmpfilename
+        self.size = 0
+        self.script_filter = None
+        self.hasher = None
+
+    @property
+    def digest(self):
+        "SHA-256 of the data written to tmpfilename."
+        return self.hasher.digest.digest()
+
+
+class HashingWriter(object):
+    "Computes the SHA-256 of the data written to fout."
+
+    def __init__(self, fout):
+        self.fout = fout
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self.digest.update(data)
+        self.fout.write(data)
+
+    def close(self):
+        self.fout.close()
+
+
+class MultipartParser(object):
     """
-    The file is created in the destination directory and its name is
-    stored in the tmpfilename attribute.
+    Streaming multipart/form-data parser.
 
-    Adds a keyword-argument "directory", which is where files are to be
-    stored. Because of CGI magic this might not be thread-safe.
+    The body is read from fp in chunks of CHUNK_SIZE bytes, and the parts of
+    the `field` form field are written as they arrive to temporary files
+    created in `directory`. Other fields are discarded. Memory use doesn't
+    depend on the size of the files.
+
+    Sizes are in bytes, a limit of None or 0 means no limit.
     """
 
-    TMPPREFIX = 'tmpdroopy'
+    CHUNK_SIZE = 64 * 1024
+    MAX_PART_HEADERS = 16 * 1024
 
-    # Would love to do a **kwargs job here but cgi has some recursive
-    # magic that passes all possible arguments positionally..
-    def __init__(self, fp=None, headers=None, outerboundary=b'',
-                 environ=os.environ, keep_blank_values=0, strict_parsing=0,
-                 limit=None, encoding='utf-8', errors='replace',
-                 directory='.'):
+    def __init__(self, fp, content_type, content_length, directory,
+                 field='upfile', max_file_size=None, max_request_size=None):
+        self.fp = fp
+        self.content_type = content_type
+        self.content_length = content_length
+        self.directory = directory
+        self.field = field
+        self.max_file_size = max_file_size
+        self.max_request_size = max_request_size
+        self.files = []
+        self.received = 0
+
+    def parse(self):
+        "Returns the list of UploadedFile. Temporary files are removed on error."
+        try:
+            self._parse()
+        except Exception:
+            for item in self.files:
+                if os.path.exists(item.tmpfilename):
+                    os.remove(item.tmpfilename)
+            raise
+        return self.files
+
+    def _read_chunks(self, length):
+        remaining = length
+        while remaining > 0:
+            chunk = self.fp.read(min(self.CHUNK_SIZE, remaining))
+            if not chunk:
+                raise UploadError(400, "Request body is truncated")
+            remaining -= len(chunk)
+            self.received += len(chunk)
+            yield chunk
+
+    def _check_request(self):
+        "Returns the delimiter of the parts and the body length."
+        msg = email.message.Message()
+        msg['content-type'] = self.content_type or ''
+        boundary = msg.get_param('boundary')
+        if msg.get_content_type() != 'multipart/form-data' or not boundary:
+            raise UploadError(400, "Not a multipart/form-data request")
+        try:
+            length = int(self.content_length)
+        except (TypeError, ValueError):
+            raise UploadError(411, "Content-Length required")
+        if self.max_request_size and length > self.max_request_size:
+            raise UploadError(413, "Request body is too large")
+        return b'\r\n--' + email.utils.collapse_rfc2231_value(boundary).encode('latin-1'), length
+
+    def _open_part(self, header_block):
+        "Returns the file to write the part to, or None to discard it."
+        msg = email.message.Message()
+        for line in header_block.decode('utf-8', 'replace').split('\r\n'):
+            if ':' in line:
+                name, value = line.split(':', 1)
+                msg[name.strip()] = value.strip()
+        name = msg.get_param('name', header='content-disposition')
+        filename = msg.get_param('filename', header='content-disposition')
+        if name is None or filename is None:
+            return None
+        name = email.utils.collapse_rfc2231_value(name)
+        filename = email.utils.collapse_rfc2231_value(filename)
+        if name != self.field or not filename:
+            return None
+        fd, tmpfilename = tempfile.mkstemp(dir=self.directory, prefix=TMPPREFIX)
+        item = UploadedFile(filename, tmpfilename)
+        self.files.append(item)
+        ### ADDED
+        # What is written to the file is hashed, after the script tag filter
+        item.hasher = HashingWriter(os.fdopen(fd, 'wb'))
+        item.script_filter = ScriptTagFilter(item.hasher)
+        return item, item.script_filter
+
+    def _write(self, part, data):
+        if part is None or not data:
+            return
+        item, fout = part
+        item.size += len(data)
+        if self.max_file_size and item.size > self.max_file_size:
+            raise UploadError(413, "File is too large: " + item.filename)
+        fout.write(data)
+
+    def _parse(self):
+        delimiter, length = self._check_request()
+        keep = len(delimiter) - 1
+        # The first delimiter isn't preceded by CRLF
+        buf = bytearray(b'\r\n')
+        state = 'preamble'
+        part = None
+        try:
+            for chunk in self._read_chunks(length):
+                buf += chunk
+                while True:
+                    if state in ('preamble', 'data'):
+                        i = buf.find(delimiter)
+                        if i < 0:
+                            # Keep what may be the start of a delimiter
+                            if len(buf) > keep:
+                                self._write(part, bytes(buf[:-keep]))
+                                del buf[:-keep]
+                            break
+                        self._write(part, bytes(buf[:i]))
+                        del buf[:i + len(delimiter)]
+                        if part is not None:
+                            part[1].close()
+                            part = None
+                        state = 'delimiter'
+                    elif state == 'delimiter':
+                        if buf[:2] == b'--':
+                            state = 'epilogue'
+                            continue
+                        # Skip the end of the delimiter line, keep its CRLF
+                        i = buf.find(b'\r\n')
+                        if i < 0:
+                            break
+                        del buf[:i]
+                        state = 'headers'
+                    elif state == 'headers':
+                        i = buf.find(b'\r\n\r\n')
+                        if i < 0:
+                            if len(buf) > self.MAX_PART_HEADERS:
+                                raise UploadError(400, "Part headers are too large")
+                            break
+                        part = self._open_part(bytes(buf[2:i]))
+                        del buf[:i + 4]
+                        state = 'data'
+                    else:
+                        # Epilogue, ignored
+                        del buf[:]
+                        break
+        finally:
+            if part is not None:
+                part[1].close()
+        if state != 'epilogue':
+            raise UploadError(400, "Malformed multipart body")
+
+
+def numbered_name(filename, n):
+    "foo.png, foo-1.png, foo-2.png..."
+    if n == 0:
+        return filename
+    root, ext = os.path.splitext(filename)
+    return "%s-%d%s" % (root, n, ext)
+
+
+re_numbered = re.compile(r"^(.*)-(\d+)$")
+
+
+def split_numbered_name(name):
+    "Returns (filename, n) if name is numbered_name(filename, n), None otherwise."
+    root, ext = os.path.splitext(name)
+    m = re_numbered.match(root)
+    if m is None:
+        return None
+    return m.group(1) + ext, int(m.group(2))
+
+
+class DirectoryListing(object):
+    """
+    Cached list of the files published from a directory.
+
+    The directory is scanned again when its mtime changes or after
+    invalidate() (called on uploads). generation is incremented whenever
+    the list of names changes.
+
+    Names are indexed by the name they are a numbered copy of (see
+    numbered_name), with the next free number, so that reserve() finds a
+    free name for an upload without probing the file system. A name like
+    2023-10.html is only a copy of 2023.html if there is a 2023.html.
+    The index is built again at each scan.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.generation = 0
+        self._names = []
+        self._name_set = set()
+        # {filename: names of filename and its numbered copies}
+        self._versions = {}
+        # {filename: number after the highest numbered copy}
+        self._next_number = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._mtime = None
+
+    def refresh(self):
+        "Scans the directory if it has changed, returns the generation."
+        mtime = os.stat(self.directory).st_mtime_ns
+        if mtime == self._mtime:
+            return self.generation
+        with self._lock:
+            if mtime == self._mtime:
+                return self.generation
+            names = []
+            # In py2, listdir() returns strings when the directory is a string.
+            for entry in os.scandir(unicode(self.directory)):
+                if entry.name.startswith(TMPPREFIX):
+                    continue
+                if entry.is_file():
+                    names.append(entry.name)
+            names.sort(key=lambda s: s.lower())
+            if names != self._names:
+                self._names = names
+                self.generation += 1
+            # Also drops the names reserved, then released
+            self._name_set = set(names)
+            self._versions, self._next_number = {}, {}
+            for name in names:
+                self._index(name)
+            # A file added within the mtime resolution wouldn't change the
+            # mtime again: keep scanning until the directory is quiet
+            if time.time() - mtime / 1e9 > 2:
+                self._mtime = mtime
+        return self.generation
+
+    def _index(self, name):
+        self._versions.setdefault(name, []).append(name)
+        numbered = split_numbered_name(name)
+        if numbered is not None and numbered[0] in self._name_set:
+            filename, n = numbered
+            self._versions.setdefault(filename, []).append(name)
+            self._next_number[filename] = max(self._next_number.get(filename, 1), n + 1)
+
+    def names(self):
+        self.refresh()
+        return self._names
+
+    def __contains__(self, name):
+        self.refresh()
+        return name in self._name_set
+
+    def versions(self, filename):
+        "filename and its numbered copies (foo.png, foo-1.png...) in the directory."
+        self.refresh()
+        with self._lock:
+            return list(self._versions.get(filename, ()))
+
+    def reserve(self, filename):
         """
-        Adds 'directory' argument to FieldStorage.__init__.
-        Retains compatibility with FieldStorage.__init__ (which involves magic)
+        Creates an empty file named filename, or after the highest numbered
+        copy of filename if it exists, and returns its path: the upload is
+        then moved over it with os.replace. The name is taken from the index,
+        O_EXCL makes sure that no other upload or process had created it.
         """
+        self.refresh()
+        with self._lock:
+            n = self._next_number.get(filename, 1) if filename in self._name_set else 0
+            while True:
+                name = numbered_name(filename, n)
+                path = os.path.join(self.directory, name)
+                try:
+                    os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600))
+                except FileExistsError:
+                    # Created since the last scan
+                    n += 1
+                    continue
+                self._name_set.add(name)
+                self._index(name)
+                return path
+
+    def release(self, path):
+        "Removes the file created by reserve(), if the upload couldn't be stored."
+        name = os.path.basename(path)
+        with self._lock:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self._name_set.discard(name)
+            for filename in (name, (split_numbered_name(name) or (None,))[0]):
+                if name in self._versions.get(filename, ()):
+                    self._versions[filename].remove(name)
+            self._mtime = None
+
+
+class ContentIndex(object):
+    """
+    SHA-256 of the files of a directory, computed once per version (inode,
+    size and mtime) of each file, to recognize files uploaded again.
+    """
+
+    def __init__(self, directory):
         self.directory = directory
-        # Not only is cgi.FieldStorage full of magic, it's DIFFERENT
-        # magic in Py2/Py3. Here's a case of the core library making
-        # life difficult, in a class that's *supposed to be subclassed*!
-        if sys.version_info > (3,):
-            cgi.FieldStorage.__init__(self, fp, headers, outerboundary,
-                                      environ, keep_blank_values,
-                                      strict_parsing, limit, encoding, errors)
-        else:
-            cgi.FieldStorage.__init__(self, fp, headers, outerboundary,
-                                      environ, keep_blank_values,
-                                      strict_parsing)
-
-    # Binary is passed in Py2 but not Py3.
-    def make_file(self, binary=None):
-        "Overrides builtin method to store tempfile in the set directory."
-        fd, name = tempfile.mkstemp(dir=self.directory, prefix=self.TMPPREFIX)
-        # Pylint doesn't like these if they're not declared in __init__ first,
-        # but setting tmpfile there leads to odd errors where it's never re-set
-        # to a file descriptor.
-        self.tmpfile = os.fdopen(fd, 'w+b')
-        self.tmpfilename = name
-        return self.tmpfile
-
-
-class HTTPUploadHandler(httpserver.BaseHTTPRequestHandler):
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def digest(self, name):
+        "Returns the SHA-256 of the file name, None if it doesn't exist."
+        path = os.path.join(self.directory, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            cached = self._digests.get(name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        digest = file_digest(path)
+        with self._lock:
+            self._digests[name] = (key, digest)
+        return digest
+
+    def find(self, digest, names):
+        "Returns the first of names whose content has this digest, or None."
+        for name in names:
+            if self.digest(name) == digest:
+                return name
+        return None
+
+
+class BlobStore(object):
+    """
+    Uploaded files stored once per content and mode, under their SHA-256
+    in directory, and hard-linked from the directories they are uploaded
+    to: files of groups with different modes (UPLOAD_CHMOD) aren't shared.
+    directory must be on the same file system as these. As the copies
+    share their data, stored files must be replaced, never modified in place.
+    HTML pages, which get edited (author tag...), aren't shared, and a blob
+    is hashed again before being linked if it has changed since.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        # {blob: (inode, size, mtime)} of the blobs found to match their name
+        self._checked = {}
+        self._lock = threading.Lock()
+
+    def path(self, digest, mode):
+        name = binascii.hexlify(digest).decode('ascii')
+        return os.path.join(self.directory, name[:2], '%s.%o' % (name, mode))
+
+    def _matches(self, blob, digest, mode):
+        "Whether blob exists, with the given mode and content."
+        st = os.stat(blob)
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if stat.S_IMODE(st.st_mode) != mode:
+            return False
+        with self._lock:
+            if self._checked.get(blob) == key:
+                return True
+        if file_digest(blob) != digest:
+            # Modified in place: its copies keep the new content, under no blob
+            os.remove(blob)
+            return False
+        with self._lock:
+            self._checked[blob] = key
+        return True
+
+    def store(self, tmpfilename, digest, localpath):
+        """
+        Replaces localpath with tmpfilename, returns True if it was linked
+        to an identical file of the same mode instead.
+        """
+        if is_html(localpath):
+            os.replace(tmpfilename, localpath)
+            return False
+        mode = stat.S_IMODE(os.stat(tmpfilename).st_mode)
+        blob = self.path(digest, mode)
+        linkname = tmpfilename + '-link'
+        try:
+            if self._matches(blob, digest, mode):
+                os.link(blob, linkname)
+                os.replace(linkname, localpath)
+                os.remove(tmpfilename)
+                return True
+        except OSError:
+            # Not stored yet, removed by collect(), not on the same file system...
+            pass
+        os.replace(tmpfilename, localpath)
+        try:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.link(localpath, blob)
+        except OSError:
+            # Stored by another upload in the meantime...
+            pass
+        return False
+
+    def collect(self):
+        "Removes the blobs not linked from any directory anymore, returns their number."
+        removed = 0
+        for dirpath, _, filenames in os.walk(self.directory):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    if os.stat(path).st_nlink == 1:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    pass
+        return removed
+
+
+@functools.lru_cache(maxsize=256)
+def accepted_languages(lhdr):
+    "Languages of an accept-language header, by decreasing preference."
+    accepted = [HTTPUploadHandler.prefcode_tuple(lang) for lang in lhdr.split(',')]
+    accepted.sort()
+    accepted.reverse()
+    return tuple(x[1] for x in accepted)
+
+
+class HTTPUploadHandler(FileSenderMixin, httpserver.BaseHTTPRequestHandler):
     "The guts of Droopy-a custom handler that accepts files & serves templates"
 
     @property
@@ -153,10 +595,23 @@ class HTTPUploadHandler(httpserver.BaseHTTPRequestHandler):
     picture = ''
     publish_files = False
     file_mode = None
-    protocol_version = 'HTTP/1.0'
+    max_file_size = None
+    max_request_size = None
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes on kept-alive connections
+    disable_nagle_algorithm = True
+    idle_timeout = 15
+    max_requests = 100
+    requests_handled = 0
+    announce_close = False
     form_field = 'upfile'
     auth = ''
     certfile = None
+    index_builder = None
+    listing = None
+    contents = None
+    blob_store = None
+    page_cache = None
     divpicture = '<div class="box"><img src="/__droopy/picture"/></div>'
 
     def get_case_insensitive_header(self, hdrname, default):
@@ -181,15 +636,14 @@ class HTTPUploadHandler(httpserver.BaseHTTPRequestHandler):
         "Parse accept-language header"
         lhdr = self.get_case_insensitive_header('accept-language', default='')
         if lhdr:
-            accepted = [self.prefcode_tuple(lang) for lang in lhdr.split(',')]
-            accepted.sort()
-            accepted.reverse()
-            return [x[1] for x in accepted]
+            ### ADDED
+            # Browsers send the same few headers again and again
+            return list(accepted_languages(lhdr))
         else:
             return []
 
-    def choose_language(self):
-        "Choose localisation based on accept-language header (default 'en')"
+    def choose_language_code(self):
+        "Choose localisation code based on accept-language header (default 'en')"
         accepted = self.parse_accepted_languages()
         # -- Choose the appropriate translation dictionary (default is english)
         lang = "en"
@@ -197,15 +651,34 @@ class HTTPUploadHandler(httpserver.BaseHTTPRequestHandler):
             if alang in self.localisations:
                 lang = alang
                 break
-        return self.localisations[lang]
+        return lang
+
+    def choose_language(self):
+        "Choose localisation based on accept-language header (default 'en')"
+        return self.localisations[self.choose_language_code()]
 
     def html(self, page):
         """
         page can be "main", "success", or "error"
         returns an html page (in the appropriate language) as a string
         """
+        ### ADDED
+        # Pages only change with the language, the file list and the client
+        lang = self.choose_language_code()
+        local = self.client_address[0] == "127.0.0.1"
+        generation = self.listing.refresh() if self.publish_files else 0
+        key = (page, lang, local)
+        cached = self.page_cache.get(key)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        htmlstr = self.render(page, lang, local)
+        self.page_cache[key] = (generation, htmlstr)
+        return htmlstr
+
+    def render(self, page, lang, local):
+        "Formats the template of page."
         dico = {}
-        dico.update(self.choose_language())
+        dico.update(self.localisations[lang])
         # -- Set message and picture
         if self.message:
             dico['message'] = '<div id="message">{0}</div>'.format(self.message)
@@ -226,7 +699,7 @@ class HTTPUploadHandler(httpserver.BaseHTTPRequestHandler):
             links = '<div id="files">' + links + '</div>'
         dico["files"] = links
         # -- Add a link to discover the url
-        if self.client_address[0] == "127.0.0.1":
+        if local:
             dico["port"] = self.server.server_port
             dico["ssl"] = int(self.certfile is not None)
             dico["linkurl"] = self.templates['linkurl'] % dico
@@ -246,73 +719,112 @@ class HTTPUploadHandler(httpserver.BaseHTTPRequestHandler):
         if self.picture != None and self.path == '/__droopy/picture':
             # send the picture
             self.send_file(self.picture)
+        ### ADDED
+        elif self.path == '/__droopy/metrics':
+            self.send_metrics()
         # TODO Verify that this is path-injection proof
-        elif name in self.published_files():
+        elif name in self.listing:
             localpath = os.path.join(self.directory, name)
             self.send_file(localpath)
         else:
             self.send_html(self.html("main"))
 
+    ### ADDED
+    # Same routes, send_file and send_html leave the body out
+    do_HEAD = do_GET
+
     @check_auth
     def do_POST(self):
         "Standard method to override in this Server object."
+        ### ADDED
+        t0 = time.monotonic()
+        parser = None
         try:
             self.log_message("Started file transfer")
             # -- Save file (numbered to avoid overwriting, ex: foo-3.png)
-            form = DroopyFieldStorage(fp=self.rfile,
-                                      directory=self.directory,
-                                      headers=self.headers,
-                                      environ={'REQUEST_METHOD': self.command})
-            file_items = form[self.form_field]
-            #-- Handle multiple file upload
-            if not isinstance(file_items, list):
-                file_items = [file_items]
+            parser = MultipartParser(
+                self.rfile,
+                self.get_case_insensitive_header('Content-Type', None),
+                self.get_case_insensitive_header('Content-Length', None),
+                self.directory,
+                self.form_field,
+                self.max_file_size,
+                self.max_request_size)
+            file_items = parser.parse()
+            stored = 0
             for item in file_items:
                 filename = _decode_str_if_py2(basename(item.filename), "utf-8")
                 if filename == "":
+                    os.remove(item.tmpfilename)
                     continue
-                localpath = _encode_str_if_py2(os.path.join(self.directory, filename), "utf-8")
-                root, ext = os.path.splitext(localpath)
-                i = 1
-                # TODO: race condition...
-                while os.path.exists(localpath):
-                    localpath = "%s-%d%s" % (root, i, ext)
-                    i = i + 1
-                if hasattr(item, 'tmpfile'):
-                    # DroopyFieldStorage.make_file() has been called
-                    item.tmpfile.close()
-                    shutil.move(item.tmpfilename, localpath)
-                else:
-                    # no temporary file, self.file is a StringIO()
-                    # see cgi.FieldStorage.read_lines()
-                    with open(localpath, "wb") as fout:
-                        shutil.copyfileobj(item.file, fout)
-                        
-                # GOOD PLACE TO PARSE FILE BEFORE WRITING IT TO DISK
                 ### ADDED
-                filter_out_script_tag(localpath)
+                # The script tag has been filtered out while writing the file
+                digest = item.digest
+                if item.script_filter.removed:
+                    self.log_message("script tag removed from %s", filename)
+                    SCRIPT_TAGS_REMOVED.inc(("streaming",))
+                elif item.script_filter.overflow:
+                    if filter_out_script_tag(item.tmpfilename):
+                        digest = file_digest(item.tmpfilename)
+                
+                # Sent again: nothing to store, nor to rebuild
+                same = self.contents.find(digest, self.listing.versions(filename))
+                if same is not None:
+                    os.remove(item.tmpfilename)
+                    self.log_message("Identical to %s: %s", same, filename)
+                    UPLOADED_FILES.inc(("identical",))
+                    continue
                 
-                if self.file_mode is not None:
-                    os.chmod(localpath, self.file_mode)
                 ### ADDED
+                localpath = self.listing.reserve(filename)
+                try:
+                    if self.file_mode is not None:
+                        os.chmod(item.tmpfilename, self.file_mode)
+                    if self.blob_store is not None and self.blob_store.store(item.tmpfilename, digest, localpath):
+                        UPLOADED_FILES.inc(("linked",))
+                    else:
+                        if self.blob_store is None:
+                            os.replace(item.tmpfilename, localpath)
+                        UPLOADED_FILES.inc(("stored",))
+                except BaseException:
+                    if os.path.exists(item.tmpfilename):
+                        # Not moved over the reserved file yet
+                        self.listing.release(localpath)
+                    raise
+                stored += 1
                 self.log_message("Received: %s", os.path.basename(localpath))
                 
             ### ADDED
-            self.log_message("updating index page")
-            update_index_page()
+            if stored:
+                self.listing.invalidate()
+                self.log_message("index page update scheduled")
+                self.index_builder.request()
 
             # -- Reply
             if self.publish_files:
                 # The file list gives a feedback for the upload success
-                self.send_resp_headers(301, {'Location': '/'}, end=True)
+                self.send_resp_headers(301, {'Location': '/', 'Content-Length': '0'}, end=True)
             else:
                 self.send_html(self.html("success"))
 
+        except UploadError as e:
+            self.log_message(repr(e))
+            # The rest of the body hasn't been read
+            self.close_after_response()
+            self.send_html(self.html("error"), e.code)
+
         except Exception as e:
             self.log_message(repr(e))
+            self.close_after_response()
             self.send_html(self.html("error"))
             # raise e  # Dev only
 
+        ### ADDED
+        finally:
+            if parser is not None:
+                RECEIVED_BYTES.inc(amount=parser.received)
+            UPLOAD_SECONDS.observe(time.monotonic() - t0)
+
     def send_resp_headers(self, response_code, headers_dict, end=False):
         "Just a shortcut for a common operation."
         self.send_response(response_code)
@@ -321,40 +833,95 @@ class HTTPUploadHandler(httpserver.BaseHTTPRequestHandler):
         if end:
             self.end_headers()
 
-    def send_html(self, htmlstr):
+    def send_html(self, htmlstr, code=200):
         "Simply returns htmlstr with the appropriate content-type/status."
-        self.send_resp_headers(200, {'Content-type': 'text/html; charset=utf-8'}, end=True)
-        self.wfile.write(htmlstr.encode("utf-8"))
-
-    def send_file(self, localpath):
-        "Does what it says on the tin! Includes correct content-type/length."
-        with open(localpath, 'rb') as f:
-            self.send_resp_headers(200,
-                                   {'Content-length': os.fstat(f.fileno())[6],
-                                    'Content-type': mimetypes.guess_type(localpath)[0]},
-                                   end=True)
-            shutil.copyfileobj(f, self.wfile)
+        body = htmlstr.encode("utf-8")
+        self.send_resp_headers(code, {'Content-type': 'text/html; charset=utf-8',
+                                      'Content-Length': str(len(body))}, end=True)
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    ### ADDED
+    def send_metrics(self):
+        "Sends the metrics in the Prometheus text format."
+        body = metrics.render().encode("utf-8")
+        self.send_resp_headers(200, {'Content-type': 'text/plain; version=0.0.4; charset=utf-8',
+                                     'Content-Length': str(len(body))}, end=True)
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def log_request(self, code='-', size='-'):
+        "Counts the responses."
+        REQUESTS.inc((self.command or '', str(int(code)) if isinstance(code, int) else str(code)))
+        httpserver.BaseHTTPRequestHandler.log_request(self, code, size)
+
+    def send_header(self, keyword, value):
+        "Counts the bytes of the response bodies."
+        if keyword.lower() == 'content-length' and self.command != 'HEAD':
+            SENT_BYTES.inc(amount=int(value))
+        httpserver.BaseHTTPRequestHandler.send_header(self, keyword, value)
+
+    @staticmethod
+    def connection_started():
+        ACTIVE_CONNECTIONS.inc()
+
+    @staticmethod
+    def connection_finished():
+        ACTIVE_CONNECTIONS.dec()
+
+    def close_after_response(self):
+        "Closes the connection once the response is sent, and says so."
+        self.close_connection = True
+        self.announce_close = True
+
+    def send_response(self, code, message=None):
+        "Adds 'Connection: close' when the connection won't be kept alive."
+        httpserver.BaseHTTPRequestHandler.send_response(self, code, message)
+        if self.announce_close:
+            self.send_header('Connection', 'close')
+
+    def parse_request(self):
+        "Limits the number of requests served on a connection."
+        if not httpserver.BaseHTTPRequestHandler.parse_request(self):
+            return False
+        self.announce_close = False
+        if not self.close_connection and self.requests_handled + 1 >= self.max_requests > 0:
+            self.close_after_response()
+        return True
+
+    def wait_for_request(self):
+        "Returns True when the next request arrives within idle_timeout."
+        timeout = self.connection.gettimeout()
+        self.connection.settimeout(self.idle_timeout)
+        try:
+            return bool(self.rfile.peek(1))
+        except socket.timeout:
+            return False
+        finally:
+            self.connection.settimeout(timeout)
 
     def published_files(self):
         "Returns the list of files that should appear as download links."
-        names = []
-        # In py2, listdir() returns strings when the directory is a string.
-        for name in os.listdir(unicode(self.directory)):
-            if name.startswith(DroopyFieldStorage.TMPPREFIX):
-                continue
-            npath = os.path.join(self.directory, name)
-            if os.path.isfile(npath):
-                names.append(name)
-        names.sort(key=lambda s: s.lower())
-        return names
+        return self.listing.names()
 
     def handle(self):
         "Lets parent object handle, but redirects socket exceptions as 'Abort's."
+        ### ADDED
+        self.connection_started()
         try:
-            httpserver.BaseHTTPRequestHandler.handle(self)
+            # Persistent connections, see wait_for_request
+            self.close_connection = True
+            self.handle_one_request()
+            while not self.close_connection:
+                self.requests_handled += 1
+                if not self.wait_for_request():
+                    break
+                self.handle_one_request()
         except socket.error as e:
             self.log_message(str(e))
             raise Abort(str(e))
+        finally:
+            self.connection_finished()
 
 
 class ThreadedHTTPServer(socketserver.ThreadingMixIn,
@@ -379,6 +946,20 @@ def run(hostname='',
         publish_files=False,
         auth='',
         certfile=None,
+        max_file_size=32*1024*1024,
+        max_request_size=128*1024*1024,
+        index_delay=2.0,
+        catalog_file=None,
+        blob_store=None,
+        groups=None,
+        engine='threads',
+        workers=8,
+        upload_workers=4,
+        header_timeout=10,
+        body_timeout=600,
+        send_timeout=60,
+        idle_timeout=15,
+        max_requests=100,
         permitted_ciphers=(
             'ECDH+AESGCM:ECDH+AES256:ECDH+AES128:ECDH+3DES'
             ':RSA+AESGCM:RSA+AES:RSA+3DES'
@@ -390,33 +971,103 @@ def run(hostname='',
     The default here is taken from:
       https://hynek.me/articles/hardening-your-web-servers-ssl-ciphers/
     ..with DH-only ciphers removed because of precomputation hazard.
+
+    max_file_size and max_request_size are the maximum sizes in bytes of an
+    uploaded file and of an upload request body (None or 0: no limit).
+
+    index_delay is the number of seconds without upload after which the
+    index page is rebuilt in the background. With catalog_file, the pages
+    are kept in that SQLite catalog (see catalog.py) by the index builder.
+
+    A file uploaded again with the same content as the file of that name
+    (or one of its numbered copies) isn't stored again. With blob_store,
+    a directory on the same file system as the upload directories, files
+    are stored once per content and mode and hard-linked (see BlobStore);
+    the blobs of files deleted since are removed at startup.
+
+    groups, if provided, is a list of (port, directory, file_mode) tuples:
+    one server is started per port, all of them in this process and sharing
+    the same index builder. port, directory and file_mode are then ignored.
+
+    engine is either 'threads' (one thread per connection, each socket
+    operation limited by timeout) or 'asyncio' (see droopy_asyncio.py:
+    connections are served by an event loop, requests by a pool of
+    `workers` threads and uploads by a pool of `upload_workers` threads,
+    with header_timeout, body_timeout (for the whole body), send_timeout
+    and idle_timeout).
+
+    Connections are kept alive (HTTP/1.1) for idle_timeout seconds between
+    two requests, and closed after max_requests requests (0: no limit).
     """
     if templates is None or localisations is None:
         raise ValueError("Must provide templates *and* localisations.")
-    socket.setdefaulttimeout(timeout)
-    HTTPUploadHandler.templates = templates
-    HTTPUploadHandler.directory = directory
-    HTTPUploadHandler.localisations = localisations
-    HTTPUploadHandler.certfile = certfile
-    HTTPUploadHandler.publish_files = publish_files
-    HTTPUploadHandler.picture = picture
-    HTTPUploadHandler.message = message
-    HTTPUploadHandler.file_mode = file_mode
-    HTTPUploadHandler.auth = auth
-    httpd = ThreadedHTTPServer((hostname, port), HTTPUploadHandler)
-    # TODO: Specify TLS1.2 only?
+    if groups is None:
+        groups = [(port, directory, file_mode)]
+    if blob_store:
+        print("Blobs of deleted files removed: %d" % BlobStore(blob_store).collect())
+    index_builder = IndexBuilder(delay=index_delay, catalog_file=catalog_file)
+    index_builder.start()
+    handlers = []
+    for group_port, group_directory, group_file_mode in groups:
+        # One handler class per directory, as settings are class attributes
+        handler = type('HTTPUploadHandler', (HTTPUploadHandler,), {
+            'templates': templates,
+            'directory': group_directory,
+            'localisations': localisations,
+            'certfile': certfile,
+            'publish_files': publish_files,
+            'picture': picture,
+            'message': message,
+            'file_mode': group_file_mode,
+            'max_file_size': max_file_size,
+            'max_request_size': max_request_size,
+            'auth': auth,
+            'listing': DirectoryListing(group_directory),
+            'contents': ContentIndex(group_directory),
+            'blob_store': BlobStore(blob_store) if blob_store else None,
+            'page_cache': {},
+            'idle_timeout': idle_timeout,
+            'max_requests': max_requests,
+            'index_builder': index_builder})
+        handlers.append((group_port, handler))
     if certfile:
         try:
             import ssl
         except:
             print("Error: Could not import module 'ssl', exiting.")
             sys.exit(2)
-        httpd.socket = ssl.wrap_socket(
-            httpd.socket,
-            certfile=certfile,
-            ciphers=permitted_ciphers,
-            server_side=True)
-    httpd.serve_forever()
+    if engine == 'asyncio':
+        import droopy_asyncio
+        ssl_context = None
+        if certfile:
+            ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            ssl_context.load_cert_chain(certfile)
+            ssl_context.set_ciphers(permitted_ciphers)
+        droopy_asyncio.AsyncIOEngine(
+            workers=workers,
+            upload_workers=upload_workers,
+            header_timeout=header_timeout,
+            body_timeout=body_timeout,
+            send_timeout=send_timeout,
+            idle_timeout=idle_timeout).serve(
+                [(hostname, group_port, handler, ssl_context)
+                 for group_port, handler in handlers])
+        return
+    socket.setdefaulttimeout(timeout)
+    servers = []
+    for group_port, handler in handlers:
+        httpd = ThreadedHTTPServer((hostname, group_port), handler)
+        # TODO: Specify TLS1.2 only?
+        if certfile:
+            httpd.socket = ssl.wrap_socket(
+                httpd.socket,
+                certfile=certfile,
+                ciphers=permitted_ciphers,
+                server_side=True)
+        servers.append(httpd)
+    for httpd in servers[1:]:
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    servers[0].serve_forever()
 
 # -- Dato
 
@@ -685,6 +1336,36 @@ def parse_args(cmd=None, ignore_defaults=False):
                         help='set up https using the certificate file')
     parser.add_argument('--chmod', type=str, default=None,
                         help='set the file permissions (octal value)')
+    parser.add_argument('--max-file-size', type=float, default=32,
+                        help='maximum size of an uploaded file, in MiB (0: no limit)')
+    parser.add_argument('--max-request-size', type=float, default=128,
+                        help='maximum size of an upload request, in MiB (0: no limit)')
+    parser.add_argument('--groups', action='store_true', default=False,
+                        help='serve every group of UPLOAD_SERVERS (update_index.py), '
+                             'each one on its own port')
+    parser.add_argument('--engine', choices=('threads', 'asyncio'), default='threads',
+                        help='serve connections with one thread each, or with asyncio')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='number of threads handling requests other than uploads (asyncio engine)')
+    parser.add_argument('--upload-workers', type=int, default=4,
+                        help='number of threads handling uploads (asyncio engine)')
+    parser.add_argument('--header-timeout', type=float, default=10,
+                        help='seconds allowed to send the request headers (asyncio engine)')
+    parser.add_argument('--body-timeout', type=float, default=600,
+                        help='seconds allowed to send the whole request body (asyncio engine)')
+    parser.add_argument('--send-timeout', type=float, default=60,
+                        help='seconds allowed for each write of the response (asyncio engine)')
+    parser.add_argument('--idle-timeout', type=float, default=15,
+                        help='seconds a connection may wait for its next request')
+    parser.add_argument('--max-requests', type=int, default=100,
+                        help='number of requests served on a connection before closing it '
+                             '(0: no limit)')
+    parser.add_argument('--index-delay', type=float, default=2.0,
+                        help='seconds without upload before the index page is rebuilt')
+    add_catalog_argument(parser)
+    parser.add_argument('--blob-store', default=None, metavar='DIRECTORY',
+                        help='store identical uploaded files once, hard-linked from this directory '
+                             '(on the same file system)')
     parser.add_argument('--save-config', action='store_true', default=False,
                         help='save options in a configuration file')
     parser.add_argument('--delete-config', action='store_true', default=False,
@@ -751,10 +1432,21 @@ def main():
         cfg = args.get('config_file', default_configfile())
         save_options(cfg)
         print("Options saved in {0}".format(cfg))
-    print("Files will be uploaded to {0}\n".format(args['directory']))
     proto = 'https' if args['ssl'] else 'http'
-    print("HTTP server starting...",
-          "Check it out at {0}://localhost:{1}".format(proto, args['port']))
+    groups = None
+    if args['groups']:
+        groups = []
+        for group, port in sorted(UPLOAD_SERVERS.items(), key=lambda g: int(g[1])):
+            directory = fullpath(os.path.join(ROOT_FOLDER, group))
+            file_mode = UPLOAD_CHMOD.get(group, args['chmod'])
+            groups.append((int(port), directory, file_mode))
+            print("Files of {0} will be uploaded to {1} ({2}://localhost:{3})".format(
+                group, directory, proto, port))
+        print("HTTP servers starting...")
+    else:
+        print("Files will be uploaded to {0}\n".format(args['directory']))
+        print("HTTP server starting...",
+              "Check it out at {0}://localhost:{1}".format(proto, args['port']))
     try:
         run(port=args['port'],
             certfile=args['ssl'],
@@ -764,6 +1456,20 @@ def main():
             file_mode=args['chmod'],
             publish_files=args['publish_files'],
             auth=args['auth'],
+            max_file_size=int(args['max_file_size'] * 1024 * 1024),
+            max_request_size=int(args['max_request_size'] * 1024 * 1024),
+            index_delay=args['index_delay'],
+            catalog_file=args['catalog'],
+            blob_store=args['blob_store'] and fullpath(args['blob_store']),
+            groups=groups,
+            engine=args['engine'],
+            workers=args['workers'],
+            upload_workers=args['upload_workers'],
+            header_timeout=args['header_timeout'],
+            body_timeout=args['body_timeout'],
+            send_timeout=args['send_timeout'],
+            idle_timeout=args['idle_timeout'],
+            max_requests=args['max_requests'],
             templates=default_templates,
             localisations=default_localisations)
     except KeyboardInterrupt:
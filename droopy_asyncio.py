@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+"""
+asyncio serving engine for droopy (droopy.py --engine asyncio).
+
+Connections are served by coroutines: a client that is slow to send its
+request costs a coroutine and fixed-size buffers, not a thread. Once the
+request line and headers are in, the request is run by HTTPUploadHandler
+in a fixed pool of worker threads, which read the body and write the
+response through the event loop. Uploads have their own pool, so that
+slow uploads don't keep the other requests (pages, published files)
+waiting for a thread.
+"""
+
+import asyncio
+import functools
+import io
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+# Same limits as http.server
+MAX_LINE = 65536
+MAX_HEADERS = 100
+
+
+class ServerInfo(object):
+    "What HTTPUploadHandler needs to know about its server."
+
+    def __init__(self, hostname, port):
+        self.server_name = hostname
+        self.server_port = port
+
+
+class ConnectionBridge(object):
+    """
+    rfile and wfile of a handler running in a worker thread.
+
+    The request line and headers have already been read and are served
+    from memory, the body is read from the connection. Reads and writes
+    are done by the event loop: the whole body must be read within
+    `body_timeout` seconds of its first read, each write must complete
+    within `send_timeout` seconds.
+    """
+
+    def __init__(self, loop, reader, writer, head, body_timeout, send_timeout):
+        self.loop = loop
+        self.reader = reader
+        self.writer = writer
+        self.head = io.BytesIO(head)
+        self.body_timeout = body_timeout
+        self.send_timeout = send_timeout
+        self.body_deadline = None
+
+    def _call(self, coro, timeout):
+        "Runs coro in the event loop and waits for its result."
+        future = asyncio.run_coroutine_threadsafe(
+            asyncio.wait_for(coro, max(0, timeout)), self.loop)
+        try:
+            return future.result()
+        except asyncio.TimeoutError:
+            # What http.server expects from a socket
+            raise socket.timeout("timed out")
+
+    def _read(self, coro):
+        if self.body_deadline is None:
+            self.body_deadline = self.loop.time() + self.body_timeout
+        return self._call(coro, self.body_deadline - self.loop.time())
+
+    def read(self, size=-1):
+        data = self.head.read(size)
+        if size is None or size < 0:
+            return data + self._read(self.reader.read())
+        if len(data) < size:
+            data += self._read(self._read_exactly(size - len(data)))
+        return data
+
+    def readline(self, size=-1):
+        line = self.head.readline(size)
+        if line.endswith(b'\n') or 0 <= size <= len(line):
+            return line
+        return line + self._read(self._readline(size - len(line) if size >= 0 else MAX_LINE))
+
+    def write(self, data):
+        self._call(self._write(data), self.send_timeout)
+        return len(data)
+
+    def flush(self):
+        "Writes are not buffered."
+
+    async def _read_exactly(self, size):
+        try:
+            return await self.reader.readexactly(size)
+        except asyncio.IncompleteReadError as e:
+            return e.partial
+
+    async def _readline(self, size):
+        try:
+            return await self.reader.readuntil(b'\n')
+        except asyncio.IncompleteReadError as e:
+            return e.partial
+        except asyncio.LimitOverrunError as e:
+            # No end of line within the buffer limit
+            return await self.reader.read(min(size, e.consumed))
+
+    async def _write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+
+class AsyncIOEngine(object):
+    """
+    Serves HTTPUploadHandler classes from a single event loop.
+
+    workers: threads running the requests other than uploads
+    upload_workers: threads running the uploads (POST requests)
+    header_timeout: time allowed to send the request line and headers
+    body_timeout: time allowed to send the whole request body
+    send_timeout: time allowed for each write of the response
+    idle_timeout: time a connection may wait for its next request
+    """
+
+    def __init__(self, workers=8, upload_workers=4, header_timeout=10, body_timeout=600,
+                 send_timeout=60, idle_timeout=15):
+        self.workers = workers
+        self.upload_workers = upload_workers
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
+        self.send_timeout = send_timeout
+        self.idle_timeout = idle_timeout
+        self.executor = None
+        self.upload_executor = None
+
+    async def read_head(self, reader, first):
+        "Returns the request line and headers, or b'' if the client has left."
+        loop = asyncio.get_running_loop()
+        timeout = self.header_timeout if first else self.idle_timeout
+        line = await asyncio.wait_for(reader.readline(), timeout)
+        head = [line]
+        deadline = loop.time() + self.header_timeout
+        while line not in (b'\r\n', b'\n', b''):
+            if len(head) > MAX_HEADERS:
+                raise ValueError("Too many headers")
+            line = await asyncio.wait_for(reader.readline(), deadline - loop.time())
+            head.append(line)
+        return b''.join(head)
+
+    @staticmethod
+    def run_handler(handler_class, bridge, client_address, server, requests_handled):
+        "Runs one request in a worker thread, returns True to close the connection."
+        handler = handler_class.__new__(handler_class)
+        handler.request = handler.connection = None
+        handler.requests_handled = requests_handled
+        handler.client_address = client_address
+        handler.server = server
+        handler.rfile = handler.wfile = bridge
+        try:
+            handler.handle_one_request()
+        except Exception as e:
+            handler.log_message(repr(e))
+            return True
+        return handler.close_connection
+
+    async def handle_connection(self, reader, writer, handler_class, server):
+        loop = asyncio.get_running_loop()
+        client_address = writer.get_extra_info('peername')[:2]
+        requests_handled = 0
+        handler_class.connection_started()
+        try:
+            while True:
+                try:
+                    head = await self.read_head(reader, requests_handled == 0)
+                except (asyncio.TimeoutError, ValueError, ConnectionError):
+                    break
+                if not head:
+                    break
+                bridge = ConnectionBridge(loop, reader, writer, head,
+                                          self.body_timeout, self.send_timeout)
+                if head.startswith(b'POST '):
+                    executor = self.upload_executor
+                else:
+                    executor = self.executor
+                close = await loop.run_in_executor(
+                    executor, self.run_handler,
+                    handler_class, bridge, client_address, server, requests_handled)
+                requests_handled += 1
+                if close:
+                    break
+        finally:
+            handler_class.connection_finished()
+            writer.close()
+
+    async def serve_all(self, servers):
+        started = []
+        for hostname, port, handler_class, ssl_context in servers:
+            callback = functools.partial(self.handle_connection,
+                                         handler_class=handler_class,
+                                         server=ServerInfo(hostname, port))
+            kwargs = {'ssl': ssl_context, 'limit': MAX_LINE}
+            if ssl_context is not None:
+                kwargs['ssl_handshake_timeout'] = self.header_timeout
+            started.append(await asyncio.start_server(
+                callback, hostname or None, port, **kwargs))
+        await asyncio.gather(*(s.serve_forever() for s in started))
+
+    def serve(self, servers):
+        "servers is a list of (hostname, port, handler_class, ssl_context)."
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.upload_executor = ThreadPoolExecutor(max_workers=self.upload_workers)
+        try:
+            asyncio.run(self.serve_all(servers))
+        finally:
+            self.executor.shutdown(wait=False)
+            self.upload_executor.shutdown(wait=False)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+"""
+File responses for http.server request handlers: cache validators,
+conditional requests, HEAD and single byte-range requests, sent with
+sendfile when possible.
+"""
+
+import os
+import re
+import socket
+import mimetypes
+import email.utils
+
+COPY_BUFSIZE = 64 * 1024
+
+re_range = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+def make_etag(st):
+    "Strong validator changing whenever the file is replaced or modified."
+    return '"{0:x}-{1:x}-{2:x}"'.format(st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def parse_range(header, size):
+    """
+    Returns (first, last) byte positions of a single 'bytes=' range,
+    None if the header must be ignored, False if it can't be satisfied.
+    """
+    m = re_range.match(header.strip())
+    if not m or not (m.group(1) or m.group(2)):
+        # Not a single byte range: answer with the whole file
+        return None
+    if not m.group(1):
+        # Last N bytes
+        suffix = int(m.group(2))
+        if suffix == 0 or size == 0:
+            return False
+        return max(0, size - suffix), size - 1
+    first = int(m.group(1))
+    if m.group(2) and int(m.group(2)) < first:
+        return None
+    if first >= size:
+        return False
+    last = int(m.group(2)) if m.group(2) else size - 1
+    return first, min(last, size - 1)
+
+
+class FileSenderMixin(object):
+    "Provides send_file to a BaseHTTPRequestHandler subclass."
+
+    def file_headers(self, localpath):
+        "Additional headers of a file response, to be overridden."
+        return {}
+
+    def not_modified(self, etag, mtime):
+        "Checks the If-None-Match and If-Modified-Since headers."
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            # Weak comparison
+            return '*' in tags or etag in tags or 'W/' + etag in tags
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError, IndexError):
+                return False
+            if since is None:
+                return False
+            return int(mtime) <= since.timestamp()
+        return False
+
+    def send_file(self, localpath):
+        "Does what it says on the tin! Includes correct content-type/length."
+        with open(localpath, 'rb') as f:
+            self.send_content(localpath, os.fstat(f.fileno()), f)
+
+    def send_content(self, localpath, st, body, etag=None, content_type=None,
+                     extra_headers=None):
+        """
+        Sends body, either the open file localpath or its content (bytes),
+        st being its stat result.
+        """
+        if etag is None:
+            etag = make_etag(st)
+        headers = {'ETag': etag,
+                   'Last-Modified': self.date_time_string(st.st_mtime)}
+        headers.update(self.file_headers(localpath))
+        if extra_headers:
+            headers.update(extra_headers)
+        if self.not_modified(etag, st.st_mtime):
+            self.send_response(304)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.end_headers()
+            return
+
+        if content_type is None:
+            content_type = mimetypes.guess_type(localpath)[0] or 'application/octet-stream'
+        headers['Content-type'] = content_type
+        headers['Accept-Ranges'] = 'bytes'
+        code, first, length = 200, 0, st.st_size
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if range_header and (if_range is None or if_range.strip() == etag):
+            byte_range = parse_range(range_header, st.st_size)
+            if byte_range is False:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{0}'.format(st.st_size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if byte_range:
+                first, last = byte_range
+                code, length = 206, last - first + 1
+                headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(first, last, st.st_size)
+        headers['Content-Length'] = str(length)
+
+        self.send_response(code)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command == 'HEAD' or not length:
+            return
+        if isinstance(body, bytes):
+            self.wfile.write(memoryview(body)[first:first + length])
+        else:
+            self.copy_file(body, first, length)
+
+    def copy_file(self, f, offset, count):
+        "Sends count bytes of f from offset, after the headers."
+        connection = getattr(self, 'connection', None)
+        if isinstance(connection, socket.socket):
+            # os.sendfile on plain sockets, falls back to send() with TLS
+            connection.sendfile(f, offset, count)
+            return
+        f.seek(offset)
+        while count > 0:
+            chunk = f.read(min(COPY_BUFSIZE, count))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            count -= len(chunk)
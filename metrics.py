@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+"""
+Counters, gauges and histograms exposed in the Prometheus text format
+(droopy.py serves them at /__droopy/metrics).
+
+Updates take one short lock per metric, so that they are exact when
+made from the threads of the servers, and cost about as much as a dict
+update.
+"""
+
+import bisect
+import threading
+
+# Metrics in creation order
+REGISTRY = []
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return repr(int(value))
+    return repr(value)
+
+
+def format_labels(names, values, extra=""):
+    pairs = ['{0}="{1}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.append(self)
+
+    def render(self):
+        lines = ["# HELP {0} {1}".format(self.name, self.help),
+                 "# TYPE {0} {1}".format(self.name, self.kind)]
+        with self._lock:
+            values = sorted(self._values.items())
+        if not values and not self.labelnames:
+            values = [((), 0)]
+        for labels, value in values:
+            lines.append("{0}{1} {2}".format(self.name, format_labels(self.labelnames, labels),
+                                             format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    "Values are [count per bucket..., count above the last bucket, sum]."
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        Metric.__init__(self, name, help, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[i] += 1
+            counts[-1] += value
+
+    def render(self):
+        lines = ["# HELP {0} {1}".format(self.name, self.help),
+                 "# TYPE {0} {1}".format(self.name, self.kind)]
+        with self._lock:
+            values = sorted((labels, list(counts)) for labels, counts in self._values.items())
+        if not values and not self.labelnames:
+            values = [((), [0] * (len(self.buckets) + 2))]
+        for labels, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append("{0}_bucket{1} {2}".format(
+                    self.name,
+                    format_labels(self.labelnames, labels, 'le="{0}"'.format(format_value(float(bound)))),
+                    cumulative))
+            label_text = format_labels(self.labelnames, labels)
+            lines.append("{0}_sum{1} {2}".format(self.name, label_text, format_value(counts[-1])))
+            lines.append("{0}_count{1} {2}".format(self.name, label_text, cumulative))
+        return lines
+
+
+def render(registry=REGISTRY):
+    "Returns the metrics in the Prometheus text exposition format."
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
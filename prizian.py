@@ -1,7 +1,15 @@
 #!/usr/bin/env python3
 
+import re
+import json
 import random
 import html
+import heapq
+import hashlib
+import argparse
+from collections import defaultdict
+
+import profiling
 
 from update_index import *
 
@@ -18,17 +26,57 @@ HTML_HEADER = """
 """
 
 
-def dre_anv_html(anviou):
+# Precedes each group section of the generated pages
+SECTION_MARKER = "  <!-- {} -->\n"
+re_section = re.compile(r"^  <!-- (.*) -->\n", re.MULTILINE)
+
+
+def section_key(entries):
+    return hashlib.sha1(repr(entries).encode("utf-8")).hexdigest()[:16]
+
+
+def render_sections(sections, render_section, cache):
+    """
+    Joins the sections {group: entries}, sorted by group. cache is a dict
+    {group: (key, text)}: the sections whose entries haven't changed are
+    taken from it, the others rendered by render_section; it is then
+    updated.
+    """
     html_text = HTML_HEADER
-    last_group = None
-    anviou = sorted(anviou, key=lambda f:f[0][2])
+    for group in sorted(sections):
+        key = section_key(sections[group])
+        cached = cache.get(group) if cache is not None else None
+        if cached is None or cached[0] != key:
+            cached = (key, SECTION_MARKER.format(group) + render_section(group, sections[group]))
+        if cache is not None:
+            cache[group] = cached
+        html_text += cached[1]
+    if cache is not None:
+        for group in set(cache).difference(sections):
+            del cache[group]
+    html_text += "</body></html>"
+    return html_text
+
+
+def read_sections(filename):
+    """ Returns {group: text} of the sections of a page written by render_sections """
+    try:
+        with open(filename, encoding="utf-8") as f:
+            text = f.read()
+    except OSError:
+        return {}
+    end = text.rfind("</body></html>")
+    matches = list(re_section.finditer(text, 0, end))
+    sections = dict()
+    for m, following in zip(matches, matches[1:] + [None]):
+        sections[m.group(1)] = text[m.start():following.start() if following else end]
+    return sections
+
+
+def dre_anv_section(group, anviou):
+    html_text = "  <h2>" + group.capitalize() + "</h2>\n"
+    html_text += "  <ul>\n"
     for anv, da_prizian in anviou:
-        if anv[2] != last_group:
-            if last_group != None:
-                html_text += "</ul>\n"
-            last_group = anv[2]
-            html_text += "  <h2>" + anv[2].capitalize() + "</h2>\n"
-            html_text += "  <ul>\n"
         html_text += "    <li class=\"dropdown\">" + html.escape("{} ({})".format(anv[0], ' & '.join(anv[1]))) + "</li>\n"
         html_text += "    <ul class=\"dropdown-content\">\n"
         for pajenn in da_prizian:
@@ -38,92 +86,356 @@ def dre_anv_html(anviou):
         html_text += "    </ul>\n"
     
     html_text += "</ul>\n"
-    html_text += "</body></html>"
-    
     return html_text
 
 
-def dre_strollad_html(groups_dict):
-    html_text = HTML_HEADER
-    strolladou = sorted(groups_dict.keys(), key=lambda f:f[1])
-    last_group = None
-    for s in strolladou:
-        if s[1] != last_group:
-            if last_group != None:
-                html_text += "</ul>\n"
-            last_group = s[1]
-            html_text += "  <h2>" + s[1].capitalize() + "</h2>\n"
-            html_text += "  <ul>\n"
-        group = " & ".join(s[0])
+def dre_anv_html(anviou, cache=None):
+    """ cache: see render_sections """
+    sections = defaultdict(list)
+    for anv, da_prizian in anviou:
+        sections[anv[2]].append((anv, tuple(da_prizian)))
+    return render_sections(sections, dre_anv_section, cache)
+
+
+def dre_strollad_section(group, strolladou):
+    html_text = "  <h2>" + group.capitalize() + "</h2>\n"
+    html_text += "  <ul>\n"
+    for s, liseidi in strolladou:
+        names = " & ".join(s[0])
         title = s[2] if s[2] else "Titl ebet"
-        html_text += "    <li class=\"dropdown\"><a href=\"{}\">{}</a> ({})</li>\n".format(s[3], title, html.escape(group))
+        html_text += "    <li class=\"dropdown\"><a href=\"{}\">{}</a> ({})</li>\n".format(s[3], title, html.escape(names))
         html_text += "    <ul class=\"dropdown-content\">\n"
-        for anv, strollad, klas in groups_dict[s]:
+        for anv, strollad, klas in liseidi:
             html_text += "      <li>{} ({}) {}</li>\n".format(anv, ' & '.join(strollad), klas.capitalize())
         
         html_text += "    </ul>\n"
     
     html_text += "</ul>\n"
-    html_text += "</body></html>"
-    
     return html_text
 
 
-if __name__ == "__main__":
-    strolladou = []
-    
-    files_list = [f for f in list_files_in(ROOT_FOLDER) if is_html(f)]
-    pages = parse_pages(files_list)
-    print("Niver a bajennoù :", len(pages))
-    strolladou = [(p["author"], p["group"], p["title"], p["filename"]) for p in pages if p["author"][0] not in ("Laure", "Gweltaz")]
-    n_strolladou = len(set(strolladou))
-    print("Niver a strolladoù :", n_strolladou)
-    if n_strolladou != len(pages):
-        # Check for duplicates
-        strolladou_sorted = sorted(strolladou)
-        for i in range(1, len(strolladou)):
-            if strolladou_sorted[i][0] == strolladou_sorted[i-1][0]:
-                print(strolladou_sorted[i-1])
-                print(strolladou_sorted[i])
+def dre_strollad_html(groups_dict, cache=None):
+    """ cache: see render_sections """
+    sections = defaultdict(list)
+    for s in groups_dict:
+        sections[s[1]].append((s, tuple(groups_dict[s])))
+    return render_sections(sections, dre_strollad_section, cache)
+
+
+# Their pages are not reviewed
+KELENNERIEN = ("Laure", "Gweltaz")
+# Number of pages reviewed by each student
+NIVER_PRIZIADENN = 5
+
+# Saved assignment, updated by --update
+PRIZIAN_FILE = "prizian.json"
+PRIZIAN_VERSION = 2
+DRE_LISEAD = "prizian_dre_lisead.html"
+DRE_STROLLAD = "prizian_dre_strollad.html"
+
+
+def get_strolladou(pages):
+    """ The pages to review, as (authors, group, title, filename), pages without author tag excluded """
+    return [(p["author"], p["group"], p["title"], p["filename"]) for p in pages
+            if p["author"] is not None and p["author"][0] not in KELENNERIEN]
+
+
+def get_liseidi(strolladou):
+    """
+    The students, as (name, authors of their page, group), each of them once.
+    Students of a group with the same name are told apart by their co-authors.
+    """
+    return list(dict.fromkeys((anv, anviou, klas) for anviou, klas, _, _ in strolladou for anv in anviou))
+
+
+def get_doublou(strolladou):
+    """
+    Returns {(name, group): pages} for the names found on pages of different
+    authors in a group: homonyms, or a student counted once per team.
+    """
+    pajennou = defaultdict(list)
+    for strollad in strolladou:
+        for anv in strollad[0]:
+            pajennou[(anv, strollad[1])].append(strollad)
+    return {lisead: p for lisead, p in pajennou.items() if len(set(s[0] for s in p)) > 1}
+
+
+def prizian(strolladou, liseidi, n=NIVER_PRIZIADENN, seed=None, cross_class=False, allowed=None,
+            previous=None):
+    """
+    Gives n pages to review to each student, never a page listing their
+    name in their group (their own pages, or those of a homonym).
+    Pages receive as even a number of reviewers as possible: each student
+    takes the pages with the fewest reviewers so far (in an order drawn
+    from seed), which costs O(n log(pages)) per student.
+    With cross_class, students only review pages of other groups (then
+    O(n (groups + log(pages))) per student). allowed(student, page), if
+    given, excludes other pairs.
+    previous is an earlier assignment {student: filenames} (see
+    load_prizian): its pairs that are still possible are kept, students
+    are given the pages they lack, then reviews are moved from the pages
+    with the most reviewers to those with the fewest, one at a time, until
+    they differ by one at most (see rebalance).
+    A student gets fewer than n pages only if there aren't enough
+    pages they may review.
+    Returns the list of [student, pages] and the dict page -> students,
+    both sorted by group and name.
+    """
+    rand = random.Random(seed)
+    # The result only depends on seed and on the pages, not on their order
+    strolladou = sorted(set(strolladou), key=lambda s: s[3])
+    liseidi = sorted(set(liseidi), key=lambda l: (l[2], l[0], l[1]))
+    rand.shuffle(liseidi)
     
-    liseidi = []
-    for anviou, klas, _, _ in strolladou:
+    # By (name, group): a student of several teams reviews none of their
+    # pages, homonyms of a group don't review each other's either
+    own_pages = defaultdict(set)
+    for i, (anviou, klas, _, _) in enumerate(strolladou):
         for anv in anviou:
-            liseidi.append((anv, anviou, klas))
+            own_pages[(anv, klas)].add(i)
     
-    print("Niver a liseidi :", len(liseidi))
+    def may_review(lisead, i):
+        if i in own_pages[(lisead[0], lisead[2])]:
+            return False
+        if cross_class and strolladou[i][1] == lisead[2]:
+            return False
+        return allowed is None or allowed(lisead, strolladou[i])
     
-    random.shuffle(strolladou)
+    # Pages of each student, as indexes in strolladou
+    assigned = dict()
+    counts = [0] * len(strolladou)
+    if previous:
+        index = {s[3]: i for i, s in enumerate(strolladou)}
+        for lisead in liseidi:
+            kept = []
+            for f in previous.get(lisead, ()):
+                i = index.get(f)
+                if i is not None and i not in kept and len(kept) < n and may_review(lisead, i):
+                    kept.append(i)
+                    counts[i] += 1
+            assigned[lisead] = kept
     
-    prizi_anv = []
-    prizi_strollad = {}
-    idx = 0
-    for anv, anviou, klas in liseidi:
-        da_prizian = []
-        for n in range(5):
-            if strolladou[idx%len(strolladou)][0] == anviou:
-                idx += 1
-            strollad = strolladou[idx%len(strolladou)]
-            da_prizian.append(strollad)
-            
-            if strollad in prizi_strollad:
-                prizi_strollad[strollad].append((anv, anviou, klas))
+    # Heaps of (number of reviewers, rank, page), one per group with cross_class
+    order = list(range(len(strolladou)))
+    rand.shuffle(order)
+    heaps = defaultdict(list)
+    for rank, i in enumerate(order):
+        heaps[strolladou[i][1] if cross_class else None].append((counts[i], rank, i))
+    for heap in heaps.values():
+        heapq.heapify(heap)
+    
+    for lisead in liseidi:
+        anv, anviou, klas = lisead
+        pages = assigned.setdefault(lisead, [])
+        excluded = own_pages[(anv, klas)].union(pages)
+        candidates = [heap for k, heap in heaps.items() if not (cross_class and k == klas)]
+        taken, skipped = [], []
+        while len(pages) + len(taken) < n:
+            heap = min((h for h in candidates if h), key=lambda h: h[0], default=None)
+            if heap is None:
+                break
+            item = heapq.heappop(heap)
+            if item[2] in excluded or (allowed is not None and not allowed(lisead, strolladou[item[2]])):
+                skipped.append((heap, item))
             else:
-                prizi_strollad[strollad] = [(anv, anviou, klas)]
-            idx += 1
-        
-        prizi_anv.append([(anv, anviou, klas), da_prizian])
+                taken.append((heap, item))
+        # Put back after the loop so that a page isn't given twice
+        for heap, (count, rank, i) in taken:
+            heapq.heappush(heap, (count + 1, rank, i))
+            counts[i] += 1
+            pages.append(i)
+        for heap, item in skipped:
+            heapq.heappush(heap, item)
+    
+    if previous:
+        rebalance(assigned, counts, may_review, rand)
     
+    prizi_anv = []
+    prizi_strollad = {strollad: [] for strollad in strolladou}
+    for lisead in sorted(assigned, key=lambda l: (l[2], l[0], l[1])):
+        da_prizian = [strolladou[i] for i in assigned[lisead]]
+        for strollad in da_prizian:
+            prizi_strollad[strollad].append(lisead)
+        prizi_anv.append([lisead, da_prizian])
+    return prizi_anv, prizi_strollad
+
+
+def self_reviews(prizi_anv):
+    """ The (student, page) pairs of prizi_anv where the student is an author of the page """
+    return [(lisead, strollad) for lisead, da_prizian in prizi_anv for strollad in da_prizian
+            if lisead[0] in strollad[0] and lisead[2] == strollad[1]]
+
+
+def rebalance(assigned, counts, may_review, rand):
     """
-    for strollad in prizi_strollad:
-        print(strollad)
-        for anv in prizi_strollad[strollad]:
-            print("   ", anv)
+    Moves reviews, one at a time, from the pages with the most reviewers to
+    the page with the fewest, until they differ by one at most or no
+    student of the former may review the latter. A moved review takes the
+    place of the old one in the list of the student.
+    Each move costs O(pages log(pages)): few are needed when some pages
+    or students are added to a balanced assignment.
+    Returns the number of moves.
     """
+    reviewers = defaultdict(list)
+    for lisead, pages in assigned.items():
+        for i in pages:
+            reviewers[i].append(lisead)
     
-    with open("prizian_dre_lisead.html", "w") as f:
-        f.write(dre_anv_html(prizi_anv))
-    
-    with open("prizian_dre_strollad.html", "w") as f:
-        f.write(dre_strollad_html(prizi_strollad))
+    moves = 0
+    stuck = set()
+    while True:
+        candidates = [i for i in range(len(counts)) if i not in stuck]
+        if not candidates:
+            return moves
+        low = min(candidates, key=lambda i: (counts[i], i))
+        donors = sorted((i for i in range(len(counts)) if counts[i] >= counts[low] + 2),
+                        key=lambda i: (-counts[i], i))
+        for donor in donors:
+            movable = [l for l in reviewers[donor] if low not in assigned[l] and may_review(l, low)]
+            if movable:
+                lisead = rand.choice(sorted(movable))
+                pages = assigned[lisead]
+                pages[pages.index(donor)] = low
+                reviewers[donor].remove(lisead)
+                reviewers[low].append(lisead)
+                counts[donor] -= 1
+                counts[low] += 1
+                moves += 1
+                break
+        else:
+            if not donors:
+                return moves
+            stuck.add(low)
+
 
+def save_prizian(filename, prizi_anv, n, seed, cross_class, sections):
+    """
+    Saves an assignment, to be updated later with --update. sections are
+    the caches of dre_anv_html and dre_strollad_html: only the keys are
+    saved, the texts being read again from the pages.
+    """
+    state = {
+        "version": PRIZIAN_VERSION,
+        "reviews": n,
+        "seed": seed,
+        "cross_class": cross_class,
+        "assignments": [{"name": lisead[0], "authors": list(lisead[1]), "group": lisead[2],
+                         "pages": [p[3] for p in da_prizian]}
+                        for lisead, da_prizian in prizi_anv],
+        "sections": {page: {group: key for group, (key, _) in cache.items()}
+                     for page, cache in sections.items()},
+    }
+    write_atomic(filename, json.dumps(state, ensure_ascii=False, indent=1))
+
+
+def load_prizian(filename):
+    """
+    Returns the state saved by save_prizian, its assignments as a dict
+    {(name, authors, group): filenames} and its sections as the caches of the
+    pages (see render_sections), or None if there is no saved assignment.
+    """
+    try:
+        with open(filename, encoding="utf-8") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    if state.get("version") != PRIZIAN_VERSION:
+        raise ValueError("{}: unknown version".format(filename))
+    state["assignments"] = {(a["name"], tuple(a["authors"]), a["group"]): a["pages"]
+                            for a in state["assignments"]}
+    for page, keys in state["sections"].items():
+        texts = read_sections(page)
+        state["sections"][page] = {group: (key, texts[group]) for group, key in keys.items() if group in texts}
+    return state
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates the prizian_dre_*.html pages")
+    parser.add_argument("-n", "--reviews", type=int, default=None,
+                        help="number of pages reviewed by each student (default: {})".format(NIVER_PRIZIADENN))
+    parser.add_argument("--seed", type=int, default=None,
+                        help="seed of the assignment, to get the same one again (default: random)")
+    parser.add_argument("--cross-class", action="store_true", default=False,
+                        help="students only review pages of other groups")
+    parser.add_argument("-u", "--update", action="store_true", default=False,
+                        help="keep the assignment saved in {} and only add the new pages and "
+                             "students (its options are used unless given)".format(PRIZIAN_FILE))
+    add_catalog_argument(parser)
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiler = profiling.NULL_PROFILER
+    if args.profile or args.profile_json:
+        profiler = profiling.Profiler(args.slowest)
+    
+    profiler.mark("walk")
+    files_list = [f for f in list_files_in(ROOT_FOLDER) if is_html(f)]
+    profiler.mark("parse")
+    catalog = open_catalog(args.catalog)
+    if catalog is not None:
+        pages = catalog.sync(files_list, profiler=profiler)
+    else:
+        pages = parse_pages(files_list, profiler=profiler)
+    profiler.mark("assign")
+    print("Niver a bajennoù :", len(pages))
+    strolladou = get_strolladou(pages)
+    print("Niver a strolladoù :", len(strolladou))
+    hep_oberour = [p["filename"] for p in pages if p["author"] is None]
+    if hep_oberour:
+        print("Pajennoù hep oberour (lakaet a-gostez) :", len(hep_oberour))
+        for f in hep_oberour:
+            print("   ", f)
+    # Counted as different students, each reviewing as many pages as the others
+    for (anv, klas), pajennou in sorted(get_doublou(strolladou).items()):
+        print("{} ({}) :".format(anv, klas), ", ".join(p[3] for p in pajennou))
+    
+    liseidi = get_liseidi(strolladou)
+    print("Niver a liseidi :", len(liseidi))
+    
+    state = load_prizian(PRIZIAN_FILE) if args.update else None
+    if args.update and state is None:
+        print("Dasparzh ebet enrollet e", PRIZIAN_FILE)
+    if state is not None:
+        n = args.reviews or state["reviews"]
+        cross_class = args.cross_class or state["cross_class"]
+        seed = args.seed if args.seed is not None else state["seed"]
+        previous = state["assignments"]
+        sections = state["sections"]
+    else:
+        n = args.reviews or NIVER_PRIZIADENN
+        cross_class = args.cross_class
+        seed = args.seed if args.seed is not None else random.randrange(2**32)
+        previous = None
+        sections = dict()
+    print("Seed :", seed)
+    prizi_anv, prizi_strollad = prizian(strolladou, liseidi, n, seed, cross_class, previous=previous)
+    
+    counts = [len(reviewers) for reviewers in prizi_strollad.values()]
+    if counts:
+        print("Niver a briziadennoù dre bajenn : {} - {}".format(min(counts), max(counts)))
+    for lisead, strollad in self_reviews(prizi_anv):
+        print("FAZI : {} ({}) a briz e bajenn {}".format(lisead[0], lisead[2], strollad[3]))
+    for lisead, da_prizian in prizi_anv:
+        if len(da_prizian) < n:
+            print("{} ({}, {}) : {} pajenn hepken".format(lisead[0], " & ".join(lisead[1]), lisead[2],
+                                                          len(da_prizian)))
+    if previous is not None:
+        changed = [lisead for lisead, da_prizian in prizi_anv
+                    if previous.get(lisead) != [p[3] for p in da_prizian]]
+        print("Liseidi o deus cheñchet pajennoù : {} / {}".format(len(changed), len(prizi_anv)))
+    
+    profiler.mark("render")
+    for page in (DRE_LISEAD, DRE_STROLLAD):
+        sections.setdefault(page, dict())
+    before = {page: {group: key for group, (key, _) in cache.items()} for page, cache in sections.items()}
+    dre_lisead = dre_anv_html(prizi_anv, sections[DRE_LISEAD])
+    dre_strollad = dre_strollad_html(prizi_strollad, sections[DRE_STROLLAD])
+    profiler.mark("write")
+    for page, text in ((DRE_LISEAD, dre_lisead), (DRE_STROLLAD, dre_strollad)):
+        if write_page(page, text):
+            rannou = [group for group, (key, _) in sorted(sections[page].items())
+                      if before[page].get(group) != key]
+            print("{} : {}".format(page, ", ".join(rannou) if previous is not None else "adnevesaet"))
+    save_prizian(PRIZIAN_FILE, prizi_anv, n, seed, cross_class, sections)
+    profiler.end()
+    if profiler.enabled:
+        profiling.report(profiler, args.profile_json)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+"""
+Per-phase timing and memory of a run of update_index.py or prizian.py
+(--profile option).
+"""
+
+import sys
+import json
+import time
+import tracemalloc
+
+
+class NullProfiler(object):
+    "Does nothing, used when profiling is off."
+    enabled = False
+
+    def mark(self, phase):
+        pass
+
+    def end(self):
+        pass
+
+    def add_file_times(self, files, times):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class Profiler(object):
+    """
+    Times consecutive phases: mark(name) starts a phase and ends the
+    previous one. Files parsed during a phase are timed one by one.
+
+    With trace_memory, the peak of the memory allocated by Python is
+    measured for each phase (tracemalloc slows the run down, and doesn't
+    see the memory of the parsing processes when --jobs is used).
+    """
+    enabled = True
+
+    def __init__(self, slowest=10, trace_memory=True):
+        self.slowest = slowest
+        self.trace_memory = trace_memory
+        self.phases = []
+        self.file_times = []
+        self._current = None
+        self._start = None
+        self._t0 = time.perf_counter()
+        if trace_memory:
+            tracemalloc.start()
+
+    def mark(self, phase):
+        self.end()
+        self._current = phase
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        self._start = time.perf_counter()
+
+    def end(self):
+        if self._current is None:
+            return
+        phase = {"name": self._current, "seconds": time.perf_counter() - self._start}
+        if self.trace_memory:
+            phase["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        self.phases.append(phase)
+        self._current = None
+
+    def add_file_times(self, files, times):
+        self.file_times.extend(zip(files, times))
+
+    def stop(self):
+        self.end()
+        self.total = time.perf_counter() - self._t0
+        self.peak_memory = None
+        if self.trace_memory:
+            self.peak_memory = max([p["peak_memory"] for p in self.phases] or [0])
+            tracemalloc.stop()
+
+    def report(self):
+        slowest = sorted(self.file_times, key=lambda f: f[1], reverse=True)[:self.slowest]
+        return {
+            "total_seconds": self.total,
+            "peak_memory": self.peak_memory,
+            "phases": self.phases,
+            "files_parsed": len(self.file_times),
+            "parse_seconds": sum(t for _, t in self.file_times),
+            "slowest_files": [{"filename": f, "seconds": t} for f, t in slowest],
+        }
+
+    def print_summary(self, out=sys.stdout):
+        report = self.report()
+        total = report["total_seconds"]
+        print("", file=out)
+        print("{:<12} {:>10} {:>7} {:>12}".format("phase", "ms", "%", "peak memory"), file=out)
+        for phase in report["phases"]:
+            memory = phase.get("peak_memory")
+            print("{:<12} {:>10.1f} {:>6.1f}% {:>12}".format(
+                phase["name"], phase["seconds"] * 1000,
+                100 * phase["seconds"] / total if total else 0,
+                format_size(memory) if memory is not None else "-"), file=out)
+        print("{:<12} {:>10.1f}".format("total", total * 1000), file=out)
+        if report["peak_memory"] is not None:
+            print("Peak memory allocated by Python: " + format_size(report["peak_memory"]), file=out)
+        print("{} files parsed, {:.1f} ms spent parsing".format(
+            report["files_parsed"], report["parse_seconds"] * 1000), file=out)
+        if report["slowest_files"]:
+            print("Slowest files:", file=out)
+            for f in report["slowest_files"]:
+                print("  {:>9.2f} ms  {}".format(f["seconds"] * 1000, f["filename"]), file=out)
+
+    def write_json(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+
+def add_arguments(parser):
+    "Adds --profile, --profile-json and --slowest to an ArgumentParser."
+    parser.add_argument("--profile", action="store_true", default=False,
+                        help="print the time and memory used by each phase")
+    parser.add_argument("--profile-json", default=None, metavar="FILE",
+                        help="also write the profile to a JSON file (implies --profile)")
+    parser.add_argument("--slowest", type=int, default=10,
+                        help="number of slowest files listed by --profile")
+
+
+def report(profiler, json_file=None):
+    "Stops profiler, prints its summary and writes it to json_file if given."
+    profiler.stop()
+    profiler.print_summary()
+    if json_file:
+        profiler.write_json(json_file)
+        print("Profile written to", json_file)
+
+
+def format_size(size):
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return "{:.0f} {}".format(size, unit) if unit == "B" else "{:.1f} {}".format(size, unit)
+        size /= 1024
+    return "{:.1f} GiB".format(size)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+"""
+Finds the pages of ROOT_FOLDER with a similar text (paragraphs and
+headings) in different groups, e.g. copied from a page of another group,
+and lists them in SIMILARITY_PAGE.
+
+Each page is summed up by a MinHash signature of its shingles (runs of
+SHINGLE_SIZE words), cached in SIMILARITY_CACHE by content hash, with the
+hash of each file: unchanged files (inode, size and mtime) are not read. Pages
+whose signatures are equal on all the rows of one of the BANDS bands
+(locality sensitive hashing) are compared: similar pages are found
+without comparing every pair of pages.
+
+    python3 similarity.py [--threshold 0.3] [--same-group] [--jobs N] [--catalog [FILE]]
+"""
+
+import re
+import html
+import json
+import random
+import hashlib
+import argparse
+from collections import defaultdict
+
+from update_index import *
+
+
+SIMILARITY_CACHE = ".similarity_cache.json"
+SIMILARITY_PAGE = "henvelder.html"
+
+SHINGLE_SIZE = 3
+NUM_PERM = 126
+# 42 bands of 3 rows: a pair of similarity 0.3 is compared with a probability
+# of 0.68, 0.94 at 0.4, 0.99 at 0.5
+BANDS = 42
+# A page with a third of its paragraphs replaced is still at 0.35 - 0.6
+THRESHOLD = 0.3
+# Pages with less text are ignored
+MIN_SHINGLES = 5
+
+MERSENNE_PRIME = (1 << 61) - 1
+# The cache is only valid for these parameters
+SIGNATURE_VERSION = [1, SHINGLE_SIZE, NUM_PERM]
+
+re_heading = re.compile(pattern_h)
+re_markup = re.compile(r"<[^>]*>")
+re_word = re.compile(r"\w+")
+
+
+def make_permutations(n, seed=1):
+    r = random.Random(seed)
+    return [(r.randrange(1, MERSENNE_PRIME), r.randrange(MERSENNE_PRIME)) for _ in range(n)]
+
+
+PERMUTATIONS = make_permutations(NUM_PERM)
+
+
+def page_words(text):
+    """ The words of the paragraphs (as counted by parse_html_file) and headings """
+    parts = []
+    analyze_html(text, parts)
+    parts.extend(re_heading.findall(text))
+    words = []
+    for part in parts:
+        words.extend(re_word.findall(html.unescape(re_markup.sub(" ", part)).lower()))
+    return words
+
+
+def shingle_hashes(words, size=SHINGLE_SIZE):
+    hashes = set()
+    for i in range(max(0, len(words) - size + 1)):
+        shingle = " ".join(words[i:i+size]).encode("utf-8")
+        hashes.add(int.from_bytes(hashlib.blake2b(shingle, digest_size=8).digest(), "little") % MERSENNE_PRIME)
+    return hashes
+
+
+def minhash(hashes):
+    """ Signature of a set of shingle hashes, None if there are too few """
+    if len(hashes) < MIN_SHINGLES:
+        return None
+    return [min((a * x + b) % MERSENNE_PRIME for x in hashes) for a, b in PERMUTATIONS]
+
+
+def text_signature(data):
+    return minhash(shingle_hashes(page_words(decode_html(data))))
+
+
+def estimate_similarity(sig1, sig2):
+    """ Estimate of the Jaccard similarity of the shingles of two pages """
+    return sum(1 for x, y in zip(sig1, sig2) if x == y) / len(sig1)
+
+
+def load_signature_cache():
+    """
+    Returns the dict read from SIMILARITY_CACHE: "signatures" {content hash:
+    signature} and "files" {filename: [file signature, content hash]}
+    """
+    try:
+        with open(SIMILARITY_CACHE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        data = dict()
+    if data.get("version") != SIGNATURE_VERSION:
+        data = dict()
+    return {"signatures": data.get("signatures", dict()), "files": data.get("files", dict())}
+
+
+def save_signature_cache(cache):
+    write_atomic(SIMILARITY_CACHE, json.dumps({"version": SIGNATURE_VERSION,
+                                               "signatures": cache["signatures"],
+                                               "files": cache["files"]}))
+
+
+def page_signatures(files, cache, jobs=1):
+    """
+    Returns {filename: signature} of the files with enough text. Signatures
+    are taken from cache (see load_signature_cache) or computed (by a pool
+    of processes with jobs > 1, one per CPU if jobs is 0) and added to it;
+    entries of other files and contents are evicted. Only the new or
+    modified files are read. Returns True too if the cache has been modified.
+    """
+    known = cache["files"]
+    cache = cache["signatures"]
+    digests = dict()
+    missing = dict()
+    files_modified = False
+    for f in files:
+        signature = file_signature(f)
+        entry = known.get(f)
+        if entry is not None and entry[0] == signature and entry[1] in cache:
+            digests[f] = entry[1]
+            continue
+        with open(f, "rb") as fin:
+            data = fin.read()
+        digest = digests[f] = hashlib.sha256(data).hexdigest()
+        known[f] = [signature, digest]
+        files_modified = True
+        if digest not in cache:
+            missing[digest] = data
+    if len(known) > len(files):
+        for f in set(known).difference(files):
+            del known[f]
+        files_modified = True
+    
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    if jobs <= 1 or len(missing) < PARALLEL_MIN_FILES:
+        computed = [text_signature(data) for data in missing.values()]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            computed = list(executor.map(text_signature, missing.values(),
+                                         chunksize=max(1, len(missing) // (jobs * 4))))
+    
+    used = dict(zip(missing, computed))
+    for digest in digests.values():
+        if digest not in used:
+            used[digest] = cache[digest]
+    modified = files_modified or used.keys() != cache.keys()
+    cache.clear()
+    cache.update(used)
+    signatures = {f: cache[d] for f, d in digests.items() if cache[d] is not None}
+    return signatures, modified
+
+
+def candidate_pairs(signatures, bands=BANDS):
+    """ Pairs of files whose signatures are equal on a band """
+    buckets = defaultdict(list)
+    for f, signature in signatures.items():
+        rows = len(signature) // bands
+        for band in range(bands):
+            buckets[(band, tuple(signature[band*rows:(band+1)*rows]))].append(f)
+    pairs = set()
+    for files in buckets.values():
+        for i in range(len(files)):
+            for j in range(i + 1, len(files)):
+                pairs.add((files[i], files[j]) if files[i] < files[j] else (files[j], files[i]))
+    return pairs
+
+
+def similar_pages(pages, cache, threshold=THRESHOLD, jobs=1, same_group=False):
+    """
+    Returns the list of (similarity, page, page) of the pages of different
+    groups (of different authors with same_group) with an estimated
+    similarity of at least threshold, and whether the cache has been
+    modified. Pairs of different groups come first, most similar first.
+    """
+    file_to_page = {p["filename"]: p for p in pages}
+    signatures, modified = page_signatures(list(file_to_page), cache, jobs)
+    similar = []
+    for f1, f2 in candidate_pairs(signatures):
+        p1, p2 = file_to_page[f1], file_to_page[f2]
+        if p1["author"] is not None and p1["author"] == p2["author"]:
+            continue
+        if p1["group"] == p2["group"] and not same_group:
+            continue
+        similarity = estimate_similarity(signatures[f1], signatures[f2])
+        if similarity >= threshold:
+            similar.append((similarity, p1, p2))
+    similar.sort(key=lambda s: (s[1]["group"] == s[2]["group"], -s[0], s[1]["filename"], s[2]["filename"]))
+    return similar, modified
+
+
+HTML_HEADER = """
+<!DOCTYPE html>
+<html>
+<head>
+  <title>Pajenno&ugrave; he&ntilde;vel</title>
+  <meta charset="UTF-8">
+  <link rel="stylesheet" type="text/css" href="index_style.css">
+</head>
+<body lang="br">
+  <h1>Pajenno&ugrave; he&ntilde;vel</h1>
+  <table>
+    <tr><th>He&ntilde;velder</th><th>Pajenn</th><th>Pajenn</th></tr>
+"""
+
+HTML_FOOTER = """  </table>
+</body>
+</html>
+"""
+
+
+def page_cell(p):
+    title = p["title"] if p["title"] else "Titl ebet"
+    authors = " & ".join(p["author"]) if p["author"] else "Goulo"
+    return "<td><a href=\"{}\" target=\"_blank\">{}</a><br>{} ({})</td>".format(
+        p["filename"], html.escape(title), html.escape(authors), p["group"])
+
+
+def similarity_html(similar):
+    yield HTML_HEADER
+    for similarity, p1, p2 in similar:
+        yield "    <tr><td>{:.0%}</td>{}{}</tr>\n".format(similarity, page_cell(p1), page_cell(p2))
+    yield HTML_FOOTER
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lists the pages with a similar text in " + SIMILARITY_PAGE)
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="minimum estimated similarity (share of common shingles) of the pages listed")
+    parser.add_argument("--same-group", action="store_true", default=False,
+                        help="also list the similar pages of a same group (after the others)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes parsing the pages (0: one per CPU)")
+    add_catalog_argument(parser)
+    args = parser.parse_args()
+
+    files_list = [f for f in list_files_in(ROOT_FOLDER) if is_html(f)]
+    catalog = open_catalog(args.catalog)
+    if catalog is not None:
+        pages = catalog.sync(files_list, args.jobs)
+    else:
+        parse_cache = load_parse_cache()
+        pages, modified = parse_pages_cached(files_list, parse_cache, args.jobs)
+        if modified:
+            save_parse_cache(parse_cache)
+
+    cache = load_signature_cache()
+    similar, modified = similar_pages(pages, cache, args.threshold, args.jobs, args.same_group)
+    if modified:
+        save_signature_cache(cache)
+    for similarity, p1, p2 in similar:
+        print("{:4.0%}  {}  {}".format(similarity, p1["filename"], p2["filename"]))
+    write_page(SIMILARITY_PAGE, similarity_html(similar))
+    print("Niver a bajennoù heñvel :", len(similar))
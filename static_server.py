@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+
+"""
+Serves the site (index.html, the pages of ROOT_FOLDER...) in place of
+`python3 -m http.server`.
+
+Small files are kept in memory and checked against their mtime on each
+request, so a rebuilt index.html is sent as soon as it is replaced.
+Larger files are sent with sendfile. Responses carry ETag, Last-Modified
+and Cache-Control headers, and connections are kept alive.
+
+A page generated in the served directory with an up to date gzip
+compressed copy next to it (index.html.gz, written by update_index.py) is
+sent compressed to the browsers accepting it. The copies are not looked
+for in the subdirectories (ROOT_FOLDER), where anyone can upload a .gz.
+
+/api/statistikou serves the rows of the diagnostic table of index.html
+(STATS_FILE), as JSON:
+
+    /api/statistikou?group=du&group=glas&sort=-number_words&page=2&per_page=50
+
+group may be repeated or comma separated (default: all groups), sort is one
+of STATS_SORT_KEYS, prefixed with - for descending order (default: url).
+"""
+
+import os
+import gzip
+import json
+import math
+import stat
+import hashlib
+import argparse
+import mimetypes
+import threading
+from collections import OrderedDict
+from http import server as httpserver
+from urllib.parse import urlsplit, parse_qs
+
+from httpfiles import FileSenderMixin, make_etag
+from update_index import STATS_FILE, STATS_VERSION
+
+STATS_SORT_KEYS = ("url", "group", "author", "title", "doctype", "structure",
+                   "number_p", "number_words", "number_img", "number_a", "note")
+STATS_PER_PAGE = 50
+STATS_MAX_PER_PAGE = 500
+# Smaller responses are sent uncompressed
+GZIP_MIN_SIZE = 1024
+
+
+class CacheEntry(object):
+
+    def __init__(self, key, data, etag):
+        self.key = key
+        self.data = data
+        self.etag = etag
+
+
+class FileCache(object):
+    """
+    LRU cache of the content of small files, bounded by the total size of
+    the files. An entry is used only while the file has the same inode,
+    size and mtime.
+    """
+
+    def __init__(self, max_bytes=32*1024*1024, max_file_size=512*1024):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.size = 0
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def cacheable(self, st):
+        return st.st_size <= self.max_file_size and st.st_size <= self.max_bytes
+
+    def get(self, path, st):
+        "Returns the entry of path if it matches st, None otherwise."
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry.key == key:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        return None
+
+    def load(self, path):
+        "Reads path and caches it, returns (stat result, entry) or None."
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            data = f.read()
+        if len(data) != st.st_size:
+            # Being written
+            return None
+        entry = CacheEntry((st.st_ino, st.st_mtime_ns, st.st_size), data, make_etag(st))
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self.size -= len(old.data)
+            self._entries[path] = entry
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted.data)
+        return st, entry
+
+
+def sort_value(value):
+    "Sort key of a STATS_FILE value: missing ones last, authors by name."
+    if isinstance(value, list):
+        value = " & ".join(value)
+    if isinstance(value, str):
+        value = value.casefold()
+    return (value is None, value)
+
+
+class StatsTable(object):
+    """
+    The rows of STATS_FILE, read again when the file is replaced. Rows
+    sorted by a key are kept until then.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.key = None
+        self.etag = None
+        self.mtime = None
+        self.rows = []
+        self.groups = []
+        self._sorted = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        "Reads the file if it has changed, raises OSError if it is missing."
+        st = os.stat(self.filename)
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            if key != self.key:
+                with open(self.filename, encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get('version') != STATS_VERSION:
+                    raise ValueError("{0}: unknown version".format(self.filename))
+                self.rows = data['pages']
+                self.groups = sorted(set(row['group'] for row in self.rows))
+                self._sorted = {}
+                self.key, self.etag, self.mtime = key, make_etag(st), st.st_mtime
+
+    def sorted_rows(self, sort, reverse):
+        with self._lock:
+            rows = self._sorted.get((sort, reverse))
+            if rows is None:
+                rows = sorted(self.rows, key=lambda row: sort_value(row.get(sort)))
+                if reverse:
+                    # Rows without value stay last
+                    rows = ([r for r in reversed(rows) if r.get(sort) is not None]
+                            + [r for r in rows if r.get(sort) is None])
+                self._sorted[(sort, reverse)] = rows
+            return rows
+
+    def query(self, groups, sort, reverse, page, per_page):
+        rows = self.sorted_rows(sort, reverse)
+        if groups:
+            rows = [row for row in rows if row['group'] in groups]
+        start = (page - 1) * per_page
+        return {
+            'version': STATS_VERSION,
+            'groups': self.groups,
+            'total': len(rows),
+            'page': page,
+            'per_page': per_page,
+            'page_count': max(1, math.ceil(len(rows) / per_page)),
+            'pages': rows[start:start + per_page],
+        }
+
+
+def parse_stats_query(query):
+    """
+    Returns (groups, sort, reverse, page, per_page) from the query string
+    of /api/statistikou, raises ValueError if it is invalid.
+    """
+    params = parse_qs(query, keep_blank_values=True)
+    groups = set()
+    for value in params.get('group', []):
+        groups.update(g for g in value.split(',') if g)
+    sort = params.get('sort', ['url'])[-1]
+    reverse = sort.startswith('-')
+    sort = sort.lstrip('-')
+    if sort not in STATS_SORT_KEYS:
+        raise ValueError("unknown sort key: " + sort)
+    page = int(params.get('page', ['1'])[-1])
+    per_page = int(params.get('per_page', [str(STATS_PER_PAGE)])[-1])
+    if page < 1 or not 1 <= per_page <= STATS_MAX_PER_PAGE:
+        raise ValueError("page must be >= 1 and per_page between 1 and {0}".format(STATS_MAX_PER_PAGE))
+    return groups, sort, reverse, page, per_page
+
+
+def guess_type(path):
+    return mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+
+def accepts_gzip(accept_encoding):
+    "Whether gzip is acceptable according to an Accept-Encoding header."
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() in ('gzip', 'x-gzip', '*'):
+            q = params.strip().lower()
+            if q.startswith('q='):
+                try:
+                    return float(q[2:]) > 0
+                except ValueError:
+                    return False
+            return True
+    return False
+
+
+def gzip_variant(path, st, directory):
+    """
+    Returns the stat result of the compressed copy of path if it is up to
+    date. Only the files at the top of directory (the generated pages) have
+    one: the files of its subdirectories are uploaded by the students.
+    """
+    if path.endswith('.gz') or os.path.dirname(path) != directory:
+        return None
+    try:
+        gz_st = os.stat(path + '.gz')
+    except OSError:
+        return None
+    if stat.S_ISREG(gz_st.st_mode) and gz_st.st_mtime_ns >= st.st_mtime_ns:
+        return gz_st
+    return None
+
+
+class StaticHandler(FileSenderMixin, httpserver.SimpleHTTPRequestHandler):
+    "Serves the files of the current directory, from the cache if possible."
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes on kept-alive connections
+    disable_nagle_algorithm = True
+    # Seconds without activity after which a connection is closed
+    timeout = 30
+    cache = None
+    max_age = 60
+    stats = None
+
+    def file_headers(self, localpath):
+        if localpath.endswith(('.html', '.htm')):
+            # Pages change at each upload: always revalidate
+            return {'Cache-Control': 'no-cache'}
+        return {'Cache-Control': 'max-age={0}'.format(self.max_age)}
+
+    def simple_handler(self):
+        "Lets SimpleHTTPRequestHandler answer (redirections, directory listings)."
+        if self.command == 'HEAD':
+            httpserver.SimpleHTTPRequestHandler.do_HEAD(self)
+        else:
+            httpserver.SimpleHTTPRequestHandler.do_GET(self)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/api/statistikou' and self.stats is not None:
+            return self.send_stats(url.query)
+        path = self.translate_path(self.path)
+        try:
+            st = os.stat(path)
+            if stat.S_ISDIR(st.st_mode):
+                if not path.endswith('/'):
+                    # Redirection to the trailing slash
+                    return self.simple_handler()
+                for index in "index.html", "index.htm":
+                    if os.path.isfile(os.path.join(path, index)):
+                        path = os.path.join(path, index)
+                        st = os.stat(path)
+                        break
+                else:
+                    return self.simple_handler()
+            if not stat.S_ISREG(st.st_mode):
+                raise FileNotFoundError(path)
+
+            variant, extra_headers = path, None
+            gz_st = gzip_variant(path, st, self.directory)
+            if gz_st is not None:
+                # The response depends on Accept-Encoding
+                extra_headers = {'Vary': 'Accept-Encoding'}
+                if accepts_gzip(self.headers.get('Accept-Encoding', '')):
+                    variant, st = path + '.gz', gz_st
+                    extra_headers['Content-Encoding'] = 'gzip'
+            self.send_variant(path, variant, st, extra_headers)
+        except OSError:
+            self.send_error(404, "File not found")
+
+    def send_variant(self, path, variant, st, extra_headers):
+        "Sends the file variant (path or its compressed copy) as path."
+        content_type = guess_type(path)
+        loaded = None
+        if self.cache is not None and self.cache.cacheable(st):
+            entry = self.cache.get(variant, st)
+            if entry is None:
+                loaded = self.cache.load(variant)
+            else:
+                loaded = st, entry
+        if loaded is not None:
+            st, entry = loaded
+            self.send_content(path, st, entry.data, entry.etag, content_type, extra_headers)
+        else:
+            with open(variant, 'rb') as f:
+                self.send_content(path, os.fstat(f.fileno()), f, None, content_type, extra_headers)
+
+    def send_stats(self, query):
+        try:
+            groups, sort, reverse, page, per_page = parse_stats_query(query)
+        except ValueError as e:
+            return self.send_error(400, str(e))
+        try:
+            self.stats.load()
+        except OSError:
+            return self.send_error(404, "File not found")
+        # Changes with the file and the query
+        etag = '"{0}-{1}"'.format(self.stats.etag.strip('"'), hashlib.sha1(
+            repr((sorted(groups), sort, reverse, page, per_page)).encode()).hexdigest()[:12])
+        headers = {'ETag': etag,
+                   'Last-Modified': self.date_time_string(self.stats.mtime),
+                   'Cache-Control': 'no-cache',
+                   'Vary': 'Accept-Encoding'}
+        if self.not_modified(etag, self.stats.mtime):
+            self.send_response(304)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.end_headers()
+            return
+
+        body = json.dumps(self.stats.query(groups, sort, reverse, page, per_page),
+                          ensure_ascii=False).encode('utf-8')
+        if len(body) >= GZIP_MIN_SIZE and accepts_gzip(self.headers.get('Accept-Encoding', '')):
+            body = gzip.compress(body, 6, mtime=0)
+            headers['Content-Encoding'] = 'gzip'
+        headers['Content-Type'] = 'application/json; charset=utf-8'
+        headers['Content-Length'] = str(len(body))
+        self.send_response(200)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    do_HEAD = do_GET
+
+
+def run(port=8000, bind='', directory='.', cache_size=32*1024*1024,
+        cache_file_size=512*1024, max_age=60):
+    handler = type('StaticHandler', (StaticHandler,), {
+        'directory': os.path.abspath(directory),
+        'cache': FileCache(cache_size, cache_file_size) if cache_size else None,
+        'max_age': max_age,
+        'stats': StatsTable(os.path.join(os.path.abspath(directory), STATS_FILE))})
+    httpd = httpserver.ThreadingHTTPServer((bind, port), handler)
+    host, port = httpd.socket.getsockname()[:2]
+    print("Serving {0} on http://{1}:{2}/".format(handler.directory, host or "0.0.0.0", port))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves the site")
+    parser.add_argument("port", type=int, nargs="?", default=8000)
+    parser.add_argument("-b", "--bind", default="",
+                        help="address to listen on (default: all)")
+    parser.add_argument("-d", "--directory", default=".",
+                        help="directory to serve (default: current directory)")
+    parser.add_argument("--cache-size", type=float, default=32,
+                        help="memory used to keep small files, in MiB (0: no cache)")
+    parser.add_argument("--cache-file-size", type=float, default=512,
+                        help="size of the largest file kept in memory, in KiB")
+    parser.add_argument("--max-age", type=int, default=60,
+                        help="seconds browsers may use images, styles and scripts "
+                             "without checking them (pages are always checked)")
+    args = parser.parse_args()
+
+    run(args.port, args.bind, args.directory,
+        int(args.cache_size * 1024 * 1024), int(args.cache_file_size * 1024), args.max_age)
@@ -0,0 +1,193 @@
+import io
+import os
+import socket
+import threading
+import http.client
+
+import pytest
+
+import droopy
+
+
+def multipart(files, boundary="BOUNDARY"):
+    body = b""
+    for filename, data in files:
+        body += (b"--" + boundary.encode() + b"\r\n"
+                 + b'Content-Disposition: form-data; name="upfile"; filename="'
+                 + filename.encode() + b'"\r\n\r\n' + data + b"\r\n")
+    body += b"--" + boundary.encode() + b"--\r\n"
+    return "multipart/form-data; boundary=" + boundary, body
+
+
+def parse(tmp_path, body, content_type, content_length, **limits):
+    parser = droopy.MultipartParser(io.BytesIO(body), content_type, content_length,
+                                    str(tmp_path), **limits)
+    return parser.parse()
+
+
+### MultipartParser
+
+def test_parse(tmp_path):
+    content_type, body = multipart([("a.txt", b"a" * 100), ("b.txt", b"b\r\n--BOUND")])
+    items = parse(tmp_path, body, content_type, str(len(body)))
+    assert [item.filename for item in items] == ["a.txt", "b.txt"]
+    with open(items[1].tmpfilename, "rb") as f:
+        assert f.read() == b"b\r\n--BOUND"
+
+
+def test_content_length_required(tmp_path):
+    content_type, body = multipart([("a.txt", b"a")])
+    with pytest.raises(droopy.UploadError) as e:
+        parse(tmp_path, body, content_type, None)
+    assert e.value.code == 411
+
+
+def test_request_too_large(tmp_path):
+    content_type, body = multipart([("a.txt", b"a" * 1000)])
+    with pytest.raises(droopy.UploadError) as e:
+        parse(tmp_path, body, content_type, str(len(body)), max_request_size=500)
+    assert e.value.code == 413
+
+
+def test_file_too_large(tmp_path):
+    content_type, body = multipart([("a.txt", b"a" * 10), ("b.txt", b"b" * 1000)])
+    with pytest.raises(droopy.UploadError) as e:
+        parse(tmp_path, body, content_type, str(len(body)), max_file_size=500)
+    assert e.value.code == 413
+    # Temporary files are removed
+    assert os.listdir(str(tmp_path)) == []
+
+
+### HTTP
+
+class IndexBuilderStub(object):
+    def request(self):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path):
+    directory = str(tmp_path)
+    handler = type('HTTPUploadHandler', (droopy.HTTPUploadHandler,), {
+        'templates': droopy.default_templates,
+        'localisations': droopy.default_localisations,
+        'directory': directory,
+        'max_file_size': 1000,
+        'max_request_size': 4000,
+        'listing': droopy.DirectoryListing(directory),
+        'contents': droopy.ContentIndex(directory),
+        'page_cache': {},
+        'index_builder': IndexBuilderStub()})
+    httpd = droopy.ThreadedHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd.server_address[1], directory
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def post(port, files):
+    content_type, body = multipart(files)
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    connection.request("POST", "/", body, {"Content-Type": content_type})
+    response = connection.getresponse()
+    response.read()
+    connection.close()
+    return response.status
+
+
+def test_http_upload(server):
+    port, directory = server
+    assert post(port, [("a.txt", b"1")]) == 200
+    assert post(port, [("a.txt", b"2")]) == 200
+    # Identical: not stored again
+    assert post(port, [("a.txt", b"1")]) == 200
+    assert sorted(os.listdir(directory)) == ["a-1.txt", "a.txt"]
+
+
+def test_http_413(server):
+    port, directory = server
+    assert post(port, [("a.txt", b"a" * 2000)]) == 413
+    assert post(port, [("a.txt", b"a" * 900)] * 5) == 413
+    assert os.listdir(directory) == []
+
+
+def test_http_411(server):
+    port, _ = server
+    sock = socket.create_connection(("127.0.0.1", port), timeout=10)
+    sock.sendall(b"POST / HTTP/1.1\r\nHost: localhost\r\n"
+                 b"Content-Type: multipart/form-data; boundary=BOUNDARY\r\n\r\n")
+    status = sock.makefile("rb").readline()
+    sock.close()
+    assert status.split()[1] == b"411"
+
+
+### DirectoryListing
+
+def touch(directory, *names):
+    for name in names:
+        open(os.path.join(str(directory), name), "w").close()
+
+
+def reserved(listing, filename):
+    return os.path.basename(listing.reserve(filename))
+
+
+def test_reserve_numbering(tmp_path):
+    listing = droopy.DirectoryListing(str(tmp_path))
+    assert reserved(listing, "foo.png") == "foo.png"
+    assert reserved(listing, "foo.png") == "foo-1.png"
+    assert reserved(listing, "foo.png") == "foo-2.png"
+    assert sorted(listing.versions("foo.png")) == ["foo-1.png", "foo-2.png", "foo.png"]
+
+
+def test_reserve_after_highest_copy(tmp_path):
+    touch(tmp_path, "foo.png", "foo-3.png")
+    listing = droopy.DirectoryListing(str(tmp_path))
+    assert reserved(listing, "foo.png") == "foo-4.png"
+
+
+def test_reserve_created_since_last_scan(tmp_path):
+    listing = droopy.DirectoryListing(str(tmp_path))
+    assert reserved(listing, "foo.png") == "foo.png"
+    # Created by another process, not seen by the index yet
+    touch(tmp_path, "foo-1.png")
+    listing._mtime = os.stat(str(tmp_path)).st_mtime_ns
+    assert reserved(listing, "foo.png") == "foo-2.png"
+
+
+def test_numbers_are_not_copies_without_the_file(tmp_path):
+    touch(tmp_path, "2023-10.html")
+    listing = droopy.DirectoryListing(str(tmp_path))
+    assert listing.versions("2023.html") == []
+    assert reserved(listing, "2023.html") == "2023.html"
+
+
+def test_release(tmp_path):
+    listing = droopy.DirectoryListing(str(tmp_path))
+    assert reserved(listing, "foo.png") == "foo.png"
+    path = listing.reserve("foo.png")
+    listing.release(path)
+    assert not os.path.exists(path)
+    assert "foo-1.png" not in listing
+    assert listing.versions("foo.png") == ["foo.png"]
+    assert reserved(listing, "foo.png") == "foo-1.png"
+
+
+def test_concurrent_reserve(tmp_path):
+    listing = droopy.DirectoryListing(str(tmp_path))
+    names = []
+    barrier = threading.Barrier(8)
+
+    def upload():
+        barrier.wait()
+        for _ in range(10):
+            names.append(reserved(listing, "foo.png"))
+
+    threads = [threading.Thread(target=upload) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(set(names)) == 80
+    assert sorted(os.listdir(str(tmp_path))) == sorted(names)
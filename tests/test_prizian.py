@@ -0,0 +1,72 @@
+import pytest
+
+import prizian
+
+
+def page(authors, group, name):
+    return (tuple(authors), group, "Titl", "pajennou/{}/{}.html".format(group, name))
+
+
+@pytest.fixture
+def strolladou():
+    return [
+        # Anna is in two teams, and there are two Youenn in du
+        page(["Anna", "Bob"], "du", "1"),
+        page(["Anna", "Carl"], "du", "2"),
+        page(["Youenn"], "du", "3"),
+        page(["Youenn", "Mai"], "du", "4"),
+        page(["Dora"], "du", "5"),
+        page(["Erwan"], "du", "6"),
+        page(["Fanch"], "glas", "1"),
+        page(["Gwen", "Hoel"], "glas", "2"),
+        page(["Anna"], "glas", "3"),
+        page(["Ivona"], "glas", "4"),
+    ]
+
+
+def authors_of(strollad, lisead):
+    return lisead[0] in strollad[0] and lisead[2] == strollad[1]
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("cross_class", [False, True])
+def test_no_self_review(strolladou, seed, cross_class):
+    liseidi = prizian.get_liseidi(strolladou)
+    prizi_anv, prizi_strollad = prizian.prizian(strolladou, liseidi, 2, seed=seed, cross_class=cross_class)
+    assert prizian.self_reviews(prizi_anv) == []
+    for lisead, da_prizian in prizi_anv:
+        for strollad in da_prizian:
+            assert not authors_of(strollad, lisead)
+            if cross_class:
+                assert strollad[1] != lisead[2]
+    for strollad, reviewers in prizi_strollad.items():
+        assert not any(authors_of(strollad, lisead) for lisead in reviewers)
+
+
+def test_homonyms_are_different_students(strolladou):
+    liseidi = prizian.get_liseidi(strolladou)
+    assert ("Youenn", ("Youenn",), "du") in liseidi
+    assert ("Youenn", ("Youenn", "Mai"), "du") in liseidi
+    # Anna of glas isn't Anna of du
+    assert ("Anna", ("Anna",), "glas") in liseidi
+    prizi_anv, _ = prizian.prizian(strolladou, liseidi, 2, seed=0)
+    assert all(len(da_prizian) == 2 for _, da_prizian in prizi_anv)
+
+
+def test_balanced(strolladou):
+    liseidi = prizian.get_liseidi(strolladou)
+    _, prizi_strollad = prizian.prizian(strolladou, liseidi, 3, seed=1)
+    counts = [len(reviewers) for reviewers in prizi_strollad.values()]
+    assert max(counts) - min(counts) <= 1
+
+
+def test_previous_self_reviews_are_dropped(strolladou):
+    liseidi = prizian.get_liseidi(strolladou)
+    anna = ("Anna", ("Anna", "Bob"), "du")
+    # Anna's other team page, kept from an older assignment
+    previous = {anna: ["pajennou/du/2.html", "pajennou/du/5.html"]}
+    prizi_anv, _ = prizian.prizian(strolladou, liseidi, 2, seed=0, previous=previous)
+    assert prizian.self_reviews(prizi_anv) == []
+    pages = dict(prizi_anv)[anna]
+    assert "pajennou/du/5.html" in [p[3] for p in pages]
+    assert "pajennou/du/2.html" not in [p[3] for p in pages]
@@ -4,10 +4,31 @@ import re
 from os import walk
 import os.path
 import html
+import json
+import gzip
+import hashlib
+import threading
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+import profiling
 
 
 ROOT_FOLDER = "pajennou"
 NOTES_FILE = "evezhiadennou.txt"
+CACHE_FILE = ".update_index_cache.json"
+# SQLite catalog of the pages and notes, used instead of CACHE_FILE with --catalog
+CATALOG_FILE = "catalog.sqlite"
+# Rows of the diagnostic table, loaded by index.html (see static_server.py)
+STATS_FILE = "statistikou.json"
+STATS_VERSION = 1
+CACHE_VERSION = 1
+# Below this number of files, starting the processes costs more than it saves
+PARALLEL_MIN_FILES = 64
+# Generated pages are encoded and written by blocks of about this size
+WRITE_BUFFER_SIZE = 64 * 1024
 UPLOAD_SERVERS = {  "gwenn1": "8000",
                     "gwenn2": "8001",
                     "ruz1"  : "8002",
@@ -16,6 +37,15 @@ UPLOAD_SERVERS = {  "gwenn1": "8000",
                     "glas"  : "8005",
                     "kelennerien": "8006",
                   }
+# Permissions given to the uploaded files (droopy.py --groups), by group.
+# Groups not listed here get the value of the --chmod option.
+UPLOAD_CHMOD = {    "gwenn2": 0o777,
+                    "ruz1"  : 0o777,
+                    "ruz2"  : 0o777,
+                    "du"    : 0o777,
+                    "glas"  : 0o777,
+                    "kelennerien": 0o777,
+               }
 
 pattern_title =     r"<title>(.+)</title>"
 pattern_author =    r"<meta\s+name\s*=\s*\"author\"\s+content\s*=\s*\"(.+)\"\s*>"
@@ -24,6 +54,14 @@ pattern_p =         r"<p>(.+)</p>"
 pattern_img =       r"<img\s(.+)>"
 pattern_a =         r"<a\s+.*href=\"(.+)\".*>.+</a>"
 
+re_author = re.compile(pattern_author)
+re_script = re.compile(rb"<script.*main\.js.*</script>")
+re_space = re.compile(r"\s*")
+
+# Openings of the tags looked for by analyze_html, one group per tag
+re_tag = re.compile(r"<(?:(a\s)|(p>)|(img\s)|(meta\s)|(title>))")
+TAG_A, TAG_P, TAG_IMG, TAG_META, TAG_TITLE = range(1, 6)
+
 
 HTML_HEADER = """
 <!DOCTYPE html>
@@ -41,20 +79,201 @@ HTML_HEADER = """
   <div class='summary'>
 """
 
+UPLOAD_LINKS_HEADER = """  <div id="upload-container">
+    <strong id="upload-text">Pellgas ur bajenn</strong>
+    <strong id="upload-arrow">&#x00BB;</strong>
+    <div id="upload-links-container">
+      <ul>
+"""
+
+UPLOAD_LINKS_FOOTER = """      </ul>
+    </div>
+  </div>
+"""
+
+KENTELIOU = """
+    <h1>Kentelioù</h1>
+    <ul class="liammou">
+      <li><a href="HTML.html" target="_blank">Ar gentel HTML e brezhoneg</a></li>
+      <li><a href="CSS.html" target="_blank">Ar gentel CSS e brezhoneg</a></li>
+      <li>Evit mon pelloc'h gant HTML ha CSS (e saozneg) : <a href="https://www.w3schools.com/" target="_blank">www.w3school.com</a></li>
+    </ul>"""
+
+OSTILHOU = """
+    <h1>Ostilhoù</h1>
+    <ul class="liammou">
+      <li class="tooltip"><a href="https://html5-editor.net/" target="_blank">html5-editor.net</a><span class="tooltiptext">Evit skriva&ntilde; HTML nemetken</span></li>
+      <li class="tooltip"><a href="https://liveweave.com/" target="_blank">liveweave.com</a><span class="tooltiptext">Evit skriva&ntilde; HTML ha CSS, labourat war 2 urzhiataer posupl</span></li>
+      <li class="tooltip"><a href="https://fonts.google.com/" target="_blank">Google Fonts</a><span class="tooltiptext">Stilo&ugrave; skritur Google da zibab (CSS)</span></li>
+      <li class="tooltip"><a href="https://www.w3schools.com/cssref/css_colors.asp" target="_blank">Livio&ugrave; CSS</a><span class="tooltiptext">Evit dibab livio&ugrave;</span></li>
+      <li class="tooltip"><a id="kaoz-link" target="_blank" href="#">Kaoz</a><span class="tooltiptext">Chat lec'hel enlinenn home-made</span></li>
+    </ul>
+    """
+
+PRIZIAN = """
+    <h1>Prizia&ntilde;</h1>
+    <ul class="liammou">
+      <li><a href="prizian_dre_lisead.html" target="_blank">Piv a prizio peseurt strollad ?</a></li>
+    </ul>
+    """
+
+STATISTIKOU_HEADER = """
+    <h1>Statistiko&ugrave;</h1>
+    <table>
+      <tr>
+        <th class="tooltip">URL<span class="tooltiptext">Anv ar fichennaoueg a rank echui&ntilde; gant .html</span></th>
+        <th class="tooltip">Oberourien<span class="tooltiptext">Merken &lt;meta name="author" content="..."&gt;</span></th>
+        <th class="tooltip">Titl<span class="tooltiptext">Kavet e vez an elfenno&ugrave; &lt;title&gt;...&lt;/title&gt;</span></th>
+        <th class="tooltip">Doctype<span class="tooltiptext">&lt;!DOCTYPE html&gt; e penn-kenta&ntilde; an teuliad HTML</span></th>
+        <th class="tooltip">Framm HTML<span class="tooltiptext">Kavet e vez ar framm<pre style="text-align:left;">  &lt;html&gt;\n    &lt;head&gt;\n    &lt;/head&gt;\n    &lt;body&gt;\n    &lt;/body&gt;\n  &lt;/html&gt;</pre></span></th>
+        <th class="tooltip">Pennad<span class="tooltiptext">Pennado&ugrave; skrid<br>&lt;p&gt;...&lt;/p&gt;</span></th>
+        <th class="tooltip">Gerioù<span class="tooltiptext">Niver a gerio&ugrave; en holl pennado&ugrave; skrid</span></th>
+        <th class="tooltip">Skeudenn<span class="tooltiptext">Skeudenno&ugrave;<br>&lt;img src="..."&gt;</span></th>
+        <th class="tooltip">Hiperliamm<span class="tooltiptext">Liammo&ugrave; hiperskrid<br>&lt;a href="..."&gt;&nbsp;...&nbsp;&lt;/a&gt;</span></th>
+        <th>Evezhiadenno&ugrave;</th>
+      </tr>
+    """
+
+STATISTIKOU_FOOTER = """
+    </table>
+    
+    <script type="application/javascript">
+      // The rows of the table are loaded group by group from static_server.py,
+      // or from STATS_FILE when the API isn't there
+      var STATISTIKOU_PER_PAGE = 100;
+      var MAT = "#99FF99", KUDENN = "#FBA";
+      
+      function statistikouCell(tr, text, color) {
+        var td = document.createElement('td');
+        td.textContent = text;
+        if (color) td.style.backgroundColor = color;
+        tr.appendChild(td);
+      }
+      
+      function statistikouRow(p) {
+        var tr = document.createElement('tr');
+        var td = document.createElement('td');
+        var a = document.createElement('a');
+        a.href = p.url;
+        a.textContent = p.url;
+        if (p.html) a.target = '_blank';
+        else td.style.backgroundColor = KUDENN;
+        td.appendChild(a);
+        tr.appendChild(td);
+        if (p.doctype === undefined) return tr;
+        if (p.author) statistikouCell(tr, p.author.join(" & "), MAT);
+        else statistikouCell(tr, "Goulo", KUDENN);
+        if (p.title !== null) statistikouCell(tr, p.title);
+        else statistikouCell(tr, "Titl ebet", KUDENN);
+        statistikouCell(tr, p.doctype ? "Mat" : "Kudenn", p.doctype ? MAT : KUDENN);
+        statistikouCell(tr, p.structure ? "Mat" : "Kudenn", p.structure ? MAT : KUDENN);
+        statistikouCell(tr, p.number_p);
+        statistikouCell(tr, p.number_words);
+        statistikouCell(tr, p.number_img);
+        statistikouCell(tr, p.number_a);
+        if (p.note !== undefined) statistikouCell(tr, p.note);
+        return tr;
+      }
+      
+      function statistikouFill(group, pages, clear) {
+        var tbody = document.getElementById('statistikou-' + group);
+        if (clear) tbody.textContent = '';
+        pages.forEach(function (p) { tbody.appendChild(statistikouRow(p)); });
+      }
+      
+      function loadStatistikouFile(groups) {
+        fetch('""" + STATS_FILE + """').then(function (response) {
+          return response.json();
+        }).then(function (data) {
+          groups.forEach(function (group) {
+            statistikouFill(group, data.pages.filter(function (p) { return p.group == group; }), true);
+          });
+        });
+      }
+      
+      function loadStatistikou(groups, page) {
+        if (!groups.length) return;
+        var url = '/api/statistikou?group=' + encodeURIComponent(groups[0]) +
+                  '&sort=url&page=' + page + '&per_page=' + STATISTIKOU_PER_PAGE;
+        fetch(url).then(function (response) {
+          if (!response.ok) throw new Error(response.status);
+          return response.json();
+        }).then(function (data) {
+          statistikouFill(groups[0], data.pages, page == 1);
+          if (page < data.page_count) loadStatistikou(groups, page + 1);
+          else loadStatistikou(groups.slice(1), 1);
+        }).catch(function () {
+          loadStatistikouFile(groups);
+        });
+      }
+      
+      loadStatistikou(Array.prototype.map.call(document.querySelectorAll('tbody.statistikou'),
+                                               function (tbody) { return tbody.dataset.group; }), 1);
+      
+"""
+
+HTML_FOOTER = """
+      document.getElementById('kaoz-link').href = "http://" + document.domain + ":8100/";
+      
+      function openInNewTab(url) {
+        var win = window.open(url, '_blank');
+        win.focus();
+      }
+    </script>
+  </body>
+</html>
+"""
+
+
 
 
 def list_files_in(directory, depth=2):
     list_files = []
     
     for dirpath, dirnames, filenames in walk(directory):
-        if len(dirpath.split(os.path.sep)) > depth:
-            continue
+        if len(dirpath.split(os.path.sep)) >= depth:
+            # Don't walk below the maximum depth
+            dirnames.clear()
         for filename in filenames:
             list_files.append(os.path.join(dirpath, filename))
     
     return list_files
 
 
+def snapshot_tree(directory, depth=2):
+    """
+    Returns a dict {filename: signature} (see file_signature) of the files
+    listed by list_files_in, in the same order.
+    """
+    snapshot = dict()
+    _scan_dir(directory, len(directory.split(os.path.sep)), depth, snapshot)
+    return snapshot
+
+
+def _scan_dir(dirpath, level, depth, snapshot):
+    subdirs = []
+    try:
+        with os.scandir(dirpath) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    # Like os.walk, don't follow symbolic links to directories
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    # Removed in the meantime or broken link
+                    continue
+                snapshot[entry.path] = [st.st_ino, st.st_size, st.st_mtime_ns]
+    except OSError:
+        return
+    
+    if level < depth:
+        for subdir in subdirs:
+            _scan_dir(subdir, level + 1, depth, snapshot)
+
+
 def list_files_by_subdirs(files_list):
     subdir = []
     dirname = ""
@@ -73,18 +292,224 @@ def list_files_by_subdirs(files_list):
     return subdir
 
 
+SCRIPT_TAGS_REMOVED = metrics.Counter("droopy_script_tags_removed_total",
+                                      "main.js script tags removed from uploaded files", ["filter"])
+INDEX_REBUILDS = metrics.Counter("droopy_index_rebuilds_total",
+                                 "Rebuilds of the index page by IndexBuilder", ["result"])
+INDEX_REBUILD_SECONDS = metrics.Histogram("droopy_index_rebuild_duration_seconds",
+                                          "Duration of the rebuilds of the index page by IndexBuilder")
+
+
 def filter_out_script_tag(filename):
+    """ Returns True if the tag was found and removed """
     text = ""
     with open(filename, "rb") as f:
         text = f.read()
     
-    m = re.search(rb"<script.*main\.js.*</script>", text)
+    m = re_script.search(text)
     if m:
         text = text[:m.start()] + text[m.end():]
         print("script tag removed from", filename)
+        with open(filename, "wb") as f:
+            f.write(text)
+        SCRIPT_TAGS_REMOVED.inc(("file",))
+    return m is not None
+
+
+class ScriptTagFilter(object):
+    """
+    Removes the main.js script tag (see filter_out_script_tag) from the data
+    written to fout, while it is written.
+    
+    re_script can't match across lines: complete lines are written at once,
+    only the end of the current line from its first "<script" is kept back,
+    up to max_line bytes. If a line is longer than that, it is written
+    unchanged and `overflow` is set, filter_out_script_tag must then be run
+    on the file.
+    """
+    
+    def __init__(self, fout, max_line=1024*1024):
+        self.fout = fout
+        self.max_line = max_line
+        self.buf = bytearray()
+        self.removed = False
+        self.overflow = False
+    
+    def write(self, data):
+        if self.removed or self.overflow:
+            self.fout.write(data)
+        else:
+            self.buf += data
+            self._filter(final=False)
+    
+    def close(self):
+        if self.buf:
+            self._filter(final=True)
+        self.fout.close()
+    
+    def _write_filtered(self, text):
+        m = re_script.search(text)
+        if m:
+            self.fout.write(text[:m.start()])
+            self.fout.write(text[m.end():])
+            self.removed = True
+        else:
+            self.fout.write(text)
     
-    with open(filename, "wb") as f:
-        f.write(text)
+    def _filter(self, final):
+        buf = self.buf
+        eol = buf.rfind(b"\n")
+        if eol >= 0:
+            self._write_filtered(bytes(buf[:eol+1]))
+            del buf[:eol+1]
+            if self.removed:
+                self.fout.write(buf)
+                del buf[:]
+                return
+        
+        # Current line
+        start = buf.find(b"<script")
+        if final:
+            self._write_filtered(bytes(buf))
+            del buf[:]
+        elif start < 0:
+            # Keep what may be the beginning of "<script"
+            keep = len("<script") - 1
+            if len(buf) > keep:
+                self.fout.write(buf[:-keep])
+                del buf[:-keep]
+        else:
+            self.fout.write(buf[:start])
+            del buf[:start]
+            if len(buf) > self.max_line:
+                self.fout.write(buf)
+                del buf[:]
+                self.overflow = True
+
+
+def decode_html(data):
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError:
+        text = data.decode("latin-1")
+    
+    # Universal newlines, as when the file is opened in text mode
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    
+    return text.strip()
+
+
+def analyze_html(text, paragraphs=None):
+    """
+    Collects the metrics of the diagnostic table in a single scan of the text.
+    The tokenizer stops on the opening of the tags we look for, the construct
+    is then matched from this position with string methods (see pattern_*).
+    Results are the same as running re.findall with every pattern.
+    The content of the paragraphs counted is appended to paragraphs if given.
+    """
+    title = None
+    author = None
+    number_p = number_words = number_img = number_a = 0
+    # findall matches don't overlap, tokens before the end of the last match
+    # (or attempt) of their pattern are skipped
+    end_p = end_img = end_a = 0
+    
+    for m in re_tag.finditer(text):
+        kind = m.lastindex
+        pos = m.start()
+        if kind == TAG_A:
+            if pos >= end_a:
+                # <a\s+.*href=\"(.+)\".*>.+</a>
+                start = re_space.match(text, pos + 2).end()
+                eol = end_of_line(text, start)
+                href = text.find('href="', start, eol)
+                quote = text.find('"', href + 7, eol) if href >= 0 else -1
+                gt = text.find('>', quote + 1, eol) if quote >= 0 else -1
+                close = text.rfind('</a>', gt + 2, eol) if gt >= 0 else -1
+                if close >= 0:
+                    number_a += 1
+                    end_a = close + 4
+                else:
+                    # The rest of the line can't match either, unless the
+                    # last <a is only followed by spaces until the next line
+                    end_a = eol
+                    last = text.rfind('<a', start, eol)
+                    if last >= 0 and text[last+2:eol+1].isspace():
+                        end_a = last
+        elif kind == TAG_P:
+            if pos >= end_p:
+                # <p>(.+)</p>
+                eol = end_of_line(text, pos)
+                close = text.rfind('</p>', pos + 4, eol)
+                if close >= 0:
+                    number_p += 1
+                    number_words += len(text[pos+3:close].split())
+                    if paragraphs is not None:
+                        paragraphs.append(text[pos+3:close])
+                    end_p = close + 4
+                else:
+                    end_p = eol
+        elif kind == TAG_IMG:
+            if pos >= end_img:
+                # <img\s(.+)>
+                eol = end_of_line(text, pos + 5)
+                close = text.rfind('>', pos + 6, eol)
+                if close >= 0:
+                    number_img += 1
+                    end_img = close + 1
+                elif text.startswith('<img', eol - 4):
+                    # <img\n continues on the next line
+                    end_img = eol - 4
+                else:
+                    end_img = eol
+        elif kind == TAG_META:
+            if author is None:
+                mm = re_author.match(text, pos)
+                if mm:
+                    author = tuple(sorted([n.strip().capitalize() for n in mm.group(1).split('&')]))
+        elif title is None:
+            # <title>(.+)</title>
+            close = text.rfind('</title>', pos + 8, end_of_line(text, pos))
+            if close >= 0:
+                title = text[pos+7:close].strip()
+    
+    d = dict()
+    # Check for DOCTYPE tag
+    d["doctype"] = text.startswith("<!DOCTYPE html>")
+    
+    # Check for HTML, HEAD and BODY tags
+    d["html_tags"] = has_tags(text, "<html>", "</html>")
+    d["head_tags"] = has_tags(text, "<head>", "</head>")
+    d["body_tags"] = has_tags(text, "<body", "</body>", attributes=True)
+    
+    d["title"] = title
+    d["author"] = author
+    d["number_p"] = number_p
+    d["number_words"] = number_words
+    d["number_img"] = number_img
+    d["number_a"] = number_a
+    
+    return d
+
+
+def has_tags(text, opening, closing, attributes=False):
+    """ Same as re.search(opening + ".*" + closing, text, flags=re.DOTALL) """
+    start = text.find(opening)
+    if start < 0:
+        return False
+    end = start + len(opening)
+    if attributes:
+        # <body.*>
+        end = text.find(">", end) + 1
+        if end == 0:
+            return False
+    return end <= text.rfind(closing)
+
+
+def end_of_line(text, pos):
+    end = text.find("\n", pos)
+    return end if end >= 0 else len(text)
 
 
 def parse_html_file(filename):
@@ -92,56 +517,190 @@ def parse_html_file(filename):
     d["filename"] = filename
     d["group"] = filename.split(os.path.sep)[1]
     
-    try:
-        with open(filename, "r", encoding="utf-8") as f:
-            text = f.read().strip()
-    except UnicodeDecodeError:
-        with open(filename, "r", encoding="latin-1") as f:
-            text = f.read().strip()
+    with open(filename, "rb") as f:
+        text = decode_html(f.read())
     
-    # Check for DOCTYPE tag
-    d["doctype"] = True if re.search(r"^<!DOCTYPE html>", text) else False
+    d.update(analyze_html(text))
     
-    # Check for HTML, HEAD and BODY tags
-    d["html_tags"] = True if re.search(r"<html>.*</html>", text, flags=re.DOTALL) else False
-    d["head_tags"] = True if re.search(r"<head>.*</head>", text, flags=re.DOTALL) else False
-    d["body_tags"] = True if re.search(r"<body.*>.*</body>", text, flags=re.DOTALL) else False
+    return d
     
-    m = re.findall(pattern_title, text, re.UNICODE)
-    if len(m) > 0:
-      d["title"] = m[0].strip()
-    else:
-      d["title"] = None
+
+def parse_html_file_timed(filename):
+    t0 = time.perf_counter()
+    page = parse_html_file(filename)
+    return page, time.perf_counter() - t0
+
+
+def parse_pages(files, jobs=1, profiler=profiling.NULL_PROFILER):
+    """
+    With jobs > 1 the files are parsed by a pool of processes (one per CPU
+    if jobs is 0). Pages are returned in the same order as the files.
+    """
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    parse = parse_html_file_timed if profiler.enabled else parse_html_file
     
-    m = re.findall(pattern_author, text)
-    if len(m) > 0:
-      # d["author"] = m[0].strip()
-      d["author"] = tuple(sorted([n.strip().capitalize() for n in m[0].split('&')]))
+    if jobs <= 1 or len(files) < PARALLEL_MIN_FILES:
+        results = []
+        for f in files:
+            results.append(parse(f))
     else:
-      d["author"] = None
-    
-    m = re.findall(pattern_p, text)
-    d["number_p"] = len(m)
-    d["number_words"] = 0
-    for p in m:
-        d["number_words"] += len(p.split())
+        # A few chunks per process to even out the load
+        chunksize = max(1, len(files) // (jobs * 4))
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(parse, files, chunksize=chunksize))
     
-    m = re.findall(pattern_img, text)
-    d["number_img"] = len(m)
+    if profiler.enabled:
+        profiler.add_file_times(files, [t for _, t in results])
+        return [page for page, _ in results]
+    return results
+
+
+def file_signature(filename):
+    st = os.stat(filename)
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+def load_parse_cache():
+    """ Returns a dict {filename: (signature, page)} read from CACHE_FILE """
+    try:
+        with open(CACHE_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return dict()
     
-    m = re.findall(pattern_a, text)
-    d["number_a"] = len(m)
+    if not isinstance(data, dict) or data.get("version") != CACHE_VERSION:
+        return dict()
     
-    return d
+    cache = dict()
+    for filename, (signature, page) in data["pages"].items():
+        # JSON has no tuples
+        if page["author"] is not None:
+            page["author"] = tuple(page["author"])
+        cache[filename] = (signature, page)
     
+    return cache
+
 
-def parse_pages(files):
-    pages = []
+def write_atomic(filename, text):
+    """ Readers see either the old or the new file, never a partial one """
+    tmp_file = "{}.{}.tmp".format(filename, os.getpid())
+    if isinstance(text, bytes):
+        with open(tmp_file, "wb") as f:
+            f.write(text)
+    else:
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            f.write(text)
+    os.replace(tmp_file, filename)
+
+
+def file_digest(filename):
+    """ SHA-256 of a file, read in chunks of WRITE_BUFFER_SIZE bytes, None if it can't be read """
+    digest = hashlib.sha256()
+    try:
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(WRITE_BUFFER_SIZE), b""):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.digest()
+
+
+def write_gzip_copy(filename):
+    """ Writes filename.gz atomically, with a fixed mtime in the header """
+    tmp_file = "{}.gz.{}.tmp".format(filename, os.getpid())
+    with open(filename, "rb") as f, open(tmp_file, "wb") as fout:
+        with gzip.GzipFile("", "wb", 9, fout, mtime=0) as gz:
+            while True:
+                data = f.read(WRITE_BUFFER_SIZE)
+                if not data:
+                    break
+                gz.write(data)
+    os.replace(tmp_file, filename + ".gz")
+
+
+def write_page(filename, text):
+    """
+    Writes a generated page, given as a string or as a sequence of
+    fragments, and its gzip compressed copy (filename.gz), served by
+    static_server.py to the browsers accepting it.
+    Nothing is written if the page hasn't changed.
+    Returns True if the page was written.
+    """
+    if isinstance(text, str):
+        text = (text,)
+    digest = hashlib.sha256()
+    tmp_file = "{}.{}.tmp".format(filename, os.getpid())
+    try:
+        with open(tmp_file, "wb") as f:
+            buffer, size = [], 0
+            for fragment in text:
+                buffer.append(fragment)
+                size += len(fragment)
+                if size >= WRITE_BUFFER_SIZE:
+                    data = "".join(buffer).encode("utf-8")
+                    digest.update(data)
+                    f.write(data)
+                    buffer, size = [], 0
+            data = "".join(buffer).encode("utf-8")
+            digest.update(data)
+            f.write(data)
+        
+        unchanged = file_digest(filename) == digest.digest()
+        if unchanged:
+            os.remove(tmp_file)
+            try:
+                # The copy must be at least as recent as the page to be served
+                if os.stat(filename + ".gz").st_mtime_ns >= os.stat(filename).st_mtime_ns:
+                    return False
+            except OSError:
+                pass
+        else:
+            os.replace(tmp_file, filename)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    write_gzip_copy(filename)
+    return not unchanged
+
+
+def save_parse_cache(cache):
+    write_atomic(CACHE_FILE, json.dumps({"version": CACHE_VERSION, "pages": cache}))
+
+
+def parse_pages_cached(files, cache, jobs=1, snapshot=None, profiler=profiling.NULL_PROFILER):
+    """
+    Same as parse_pages but only new or modified files are parsed again.
+    A file is considered unchanged if its inode, size and mtime are the same.
+    These are taken from the snapshot (see snapshot_tree) when one is given.
+    Entries of files that are not in the list anymore are evicted from the cache.
+    Returns the list of pages, and True if the cache has been modified.
+    """
+    modified = False
     
+    to_parse = []
+    signatures = dict()
     for f in files:
-        pages.append(parse_html_file(f))
+        signature = snapshot[f] if snapshot else file_signature(f)
+        entry = cache.get(f)
+        if entry is None or entry[0] != signature:
+            to_parse.append(f)
+            signatures[f] = signature
     
-    return pages
+    for page in parse_pages(to_parse, jobs, profiler):
+        cache[page["filename"]] = (signatures[page["filename"]], page)
+        modified = True
+    
+    pages = [cache[f][1] for f in files]
+    
+    if len(cache) > len(files):
+        files = set(files)
+        for f in [f for f in cache if f not in files]:
+            del cache[f]
+        modified = True
+    
+    return pages, modified
 
 
 def parse_evezhiadennou():
@@ -165,179 +724,328 @@ def is_html(filename):
     return filename.lower().endswith('.html') or filename.lower().endswith('.htm')
     
 
-def update_index_page():
-    all_files = list_files_in(ROOT_FOLDER)
-    html_files = [f for f in all_files if is_html(f)]
-    group_of_files = [[f for f in sub] for sub in list_files_by_subdirs(html_files)]
-    
-    pages = parse_pages(html_files)
-    file_to_page = dict()
-    for p in pages:
-        file_to_page[p["filename"]] = p
+class IndexRenderer(object):
+    """
+    Renders index.html as a sequence of fragments.
+    The group columns are kept between two rebuilds, and rendered again
+    only when their inputs have changed.
+    """
     
-    evezhiadennou = parse_evezhiadennou()
+    def __init__(self):
+        self.columns = dict()
     
-    text = HTML_HEADER
+    def render(self, all_files, group_of_files, file_to_page, prizian_link):
+        columns = dict()
+        
+        yield HTML_HEADER
+        
+        # Pajennoù liseidi
+        group_names = []
+        for files in group_of_files:
+            group_name = files[0].split(os.path.sep)[1]
+            group_names.append(group_name)
+            yield self.column(group_name, files, file_to_page, columns)
+        
+        yield "  </div>\n\n"
+        
+        # Upload links
+        yield UPLOAD_LINKS_HEADER
+        for group_name in sorted(group_names):
+            yield "       <li><a href='#' id='upload-link-{}' class='upload-link {}' target='_blank'>{}</a></li>\n".format(group_name, group_name, group_name)
+        yield UPLOAD_LINKS_FOOTER
+        
+        yield KENTELIOU
+        yield OSTILHOU
+        if prizian_link:
+            yield PRIZIAN
+        
+        ### DIAGNOSTIC TABLE
+        # Rows are loaded by the page, group by group (see STATISTIKOU_FOOTER)
+        yield STATISTIKOU_HEADER
+        for group_name in sorted(set(f.split(os.path.sep)[1] for f in all_files)):
+            yield "    <tbody id='statistikou-{0}' class='statistikou' data-group='{0}'>".format(group_name)
+            yield "<tr><td colspan='10'>O karga&ntilde;...</td></tr></tbody>\n"
+        yield STATISTIKOU_FOOTER
+        
+        for folder_name in group_names:
+            yield f"""      document.getElementById('upload-link-{folder_name}').href = 'http://' + document.domain + ':{UPLOAD_SERVERS[folder_name]}/';\n"""
+        
+        yield HTML_FOOTER
+        
+        # Fragments of removed groups are dropped
+        self.columns = columns
     
-    # Pajennoù liseidi
-    group_names = []
-    for files in group_of_files:
-        text += "    <div class='column'>\n"
-        group_name = files[0].split(os.path.sep)[1]
-        group_names.append(group_name)
+    def column(self, group_name, files, file_to_page, columns):
+        files = sorted(files)
+        key = tuple(file_to_page[f]["title"] for f in files)
+        cached = self.columns.get(group_name)
+        if cached is not None and cached[0] == files and cached[1] == key:
+            columns[group_name] = cached
+            return cached[2]
+        
+        text = "    <div class='column'>\n"
         text += "      <h2 class='group-title {}'>".format(group_name) + group_name + "</h2>\n"
         text += "      <ul>\n"
-        for f in sorted(files):
+        for f in files:
             text +=  "        <li>"
             text += f'<a class="page-title" href="{f}" target="_blank">{file_to_page[f]["title"]}</a><br>'
             text +=  "</li>\n"
         
         text += "      </ul>\n"
         text += "    </div>\n"
+        columns[group_name] = (files, key, text)
+        return text
+
+
+def page_stats(all_files, file_to_page, evezhiadennou):
+    """
+    Returns the rows of the diagnostic table, sorted by file: url, group and
+    html for every file, the results of parse_html_file and the note of
+    the authors for the pages.
+    """
+    stats = []
+    for f in sorted(all_files):
+        entry = {"url": f, "group": f.split(os.path.sep)[1], "html": is_html(f)}
+        p = file_to_page.get(f)
+        if p is not None:
+            entry["author"] = p["author"]
+            entry["title"] = p["title"]
+            entry["doctype"] = p["doctype"]
+            entry["structure"] = p["html_tags"] and p["head_tags"] and p["body_tags"]
+            for key in ("number_p", "number_words", "number_img", "number_a"):
+                entry[key] = p[key]
+            if p["author"] in evezhiadennou:
+                entry["note"] = evezhiadennou[p["author"]]
+        stats.append(entry)
+    return stats
+
+
+INDEX_RENDERER = IndexRenderer()
+
+
+def update_index_page(jobs=1, snapshot=None, profiler=profiling.NULL_PROFILER, catalog=None, use_cache=True):
+    """
+    catalog: a catalog.Catalog, brought up to date and read instead of the parse cache
+    use_cache: if False, all the pages are parsed, the parse cache and the catalog are left alone
+    """
+    profiler.mark("walk")
+    if snapshot is not None:
+        all_files = list(snapshot)
+    else:
+        all_files = list_files_in(ROOT_FOLDER)
+    html_files = [f for f in all_files if is_html(f)]
+    group_of_files = [[f for f in sub] for sub in list_files_by_subdirs(html_files)]
     
-    text += "  </div>\n\n"
-    
-    # Upload links
-    text += """  <div id="upload-container">
-    <strong id="upload-text">Pellgas ur bajenn</strong>
-    <strong id="upload-arrow">&#x00BB;</strong>
-    <div id="upload-links-container">
-      <ul>
-"""
+    profiler.mark("parse")
+    if not use_cache:
+        pages = parse_pages(html_files, jobs, profiler)
+    elif catalog is not None:
+        pages = catalog.sync(html_files, jobs, snapshot, profiler)
+    else:
+        cache = load_parse_cache()
+        pages, modified = parse_pages_cached(html_files, cache, jobs, snapshot, profiler)
+        if modified:
+            save_parse_cache(cache)
+    file_to_page = dict()
+    for p in pages:
+        file_to_page[p["filename"]] = p
     
-    for group_name in sorted(group_names):
-        text += "       <li><a href='#' id='upload-link-{}' class='upload-link {}' target='_blank'>{}</a></li>\n".format(group_name, group_name, group_name)
+    profiler.mark("notes")
+    if catalog is not None:
+        catalog.sync_notes()
+        evezhiadennou = catalog.notes()
+    else:
+        evezhiadennou = parse_evezhiadennou()
     
-    text += """      </ul>
-    </div>
-  </div>
-"""
+    profiler.mark("stats")
+    # Written first: the new index may refer to new groups
+    stats = page_stats(all_files, file_to_page, evezhiadennou)
+    write_page(STATS_FILE, json.dumps({"version": STATS_VERSION, "pages": stats}, ensure_ascii=False))
     
-    ### Kenteliou
-    text += """
-    <h1>Kentelioù</h1>
-    <ul class="liammou">
-      <li><a href="HTML.html" target="_blank">Ar gentel HTML e brezhoneg</a></li>
-      <li><a href="CSS.html" target="_blank">Ar gentel CSS e brezhoneg</a></li>
-      <li>Evit mon pelloc'h gant HTML ha CSS (e saozneg) : <a href="https://www.w3schools.com/" target="_blank">www.w3school.com</a></li>
-    </ul>"""
+    profiler.mark("render")
+    fragments = INDEX_RENDERER.render(all_files, group_of_files, file_to_page,
+                                      os.path.exists("prizian_dre_lisead.html"))
+    if profiler.enabled:
+        # The fragments are otherwise rendered while being written
+        fragments = list(fragments)
     
-    ### Ostilhoù
-    text += """
-    <h1>Ostilhoù</h1>
-    <ul class="liammou">
-      <li class="tooltip"><a href="https://html5-editor.net/" target="_blank">html5-editor.net</a><span class="tooltiptext">Evit skriva&ntilde; HTML nemetken</span></li>
-      <li class="tooltip"><a href="https://liveweave.com/" target="_blank">liveweave.com</a><span class="tooltiptext">Evit skriva&ntilde; HTML ha CSS, labourat war 2 urzhiataer posupl</span></li>
-      <li class="tooltip"><a href="https://fonts.google.com/" target="_blank">Google Fonts</a><span class="tooltiptext">Stilo&ugrave; skritur Google da zibab (CSS)</span></li>
-      <li class="tooltip"><a href="https://www.w3schools.com/cssref/css_colors.asp" target="_blank">Livio&ugrave; CSS</a><span class="tooltiptext">Evit dibab livio&ugrave;</span></li>
-      <li class="tooltip"><a id="kaoz-link" target="_blank" href="#">Kaoz</a><span class="tooltiptext">Chat lec'hel enlinenn home-made</span></li>
-    </ul>
+    profiler.mark("write")
+    if write_page("index.html", fragments):
+        print("Index.html file updated")
+    else:
+        print("Index.html file unchanged")
+    profiler.end()
+
+
+class IndexBuilder(threading.Thread):
     """
-    
-    ### Priziañ
-    if os.path.exists("prizian_dre_lisead.html"):
-        text += """
-    <h1>Prizia&ntilde;</h1>
-    <ul class="liammou">
-      <li><a href="prizian_dre_lisead.html" target="_blank">Piv a prizio peseurt strollad ?</a></li>
-    </ul>
+    Rebuilds the index page in a background thread.
+    Bursts of requests are coalesced into a single rebuild, which happens
+    once no request has been made for `delay` seconds (but no later than
+    `max_delay` seconds after the first request of the burst).
+    With catalog_file, the pages are kept in that SQLite catalog.
     """
     
-    ### DIAGNOSTIC TABLE
-    text += """
-    <h1>Statistiko&ugrave;</h1>
-    <table>
-      <tr>
-        <th class="tooltip">URL<span class="tooltiptext">Anv ar fichennaoueg a rank echui&ntilde; gant .html</span></th>
-        <th class="tooltip">Oberourien<span class="tooltiptext">Merken &lt;meta name="author" content="..."&gt;</span></th>
-        <th class="tooltip">Titl<span class="tooltiptext">Kavet e vez an elfenno&ugrave; &lt;title&gt;...&lt;/title&gt;</span></th>
-        <th class="tooltip">Doctype<span class="tooltiptext">&lt;!DOCTYPE html&gt; e penn-kenta&ntilde; an teuliad HTML</span></th>
-        <th class="tooltip">Framm HTML<span class="tooltiptext">Kavet e vez ar framm<pre style="text-align:left;">  &lt;html&gt;\n    &lt;head&gt;\n    &lt;/head&gt;\n    &lt;body&gt;\n    &lt;/body&gt;\n  &lt;/html&gt;</pre></span></th>
-        <th class="tooltip">Pennad<span class="tooltiptext">Pennado&ugrave; skrid<br>&lt;p&gt;...&lt;/p&gt;</span></th>
-        <th class="tooltip">Gerioù<span class="tooltiptext">Niver a gerio&ugrave; en holl pennado&ugrave; skrid</span></th>
-        <th class="tooltip">Skeudenn<span class="tooltiptext">Skeudenno&ugrave;<br>&lt;img src="..."&gt;</span></th>
-        <th class="tooltip">Hiperliamm<span class="tooltiptext">Liammo&ugrave; hiperskrid<br>&lt;a href="..."&gt;&nbsp;...&nbsp;&lt;/a&gt;</span></th>
-        <th>Evezhiadenno&ugrave;</th>
-      </tr>
-    """
+    def __init__(self, delay=2.0, max_delay=30.0, catalog_file=None):
+        threading.Thread.__init__(self, name="IndexBuilder", daemon=True)
+        self.delay = delay
+        self.max_delay = max_delay
+        self.catalog_file = catalog_file
+        self._requested = threading.Event()
+        self._lock = threading.Lock()
+        self._first_request = None
+        self._last_request = None
     
-    for f in sorted(all_files):
-        text += "<tr>\n"
-        
-        if is_html(f):
-            text += "<td>"
-            text += f"<a href=\"{f}\" target=\"_blank\">"
-            text += html.escape(f)
-            text += "</a></td>\n"
-        else:
-            text += "<td style=\"background-color:#FBA\">"
-            text += f"<a href=\"{f}\">"
-            text += html.escape(f)
-            text += "</a></td>\n"
-        
-        if f in file_to_page:
-            p = file_to_page[f]
-            
-            if p["author"]:
-                names = p["author"][0] if len(p["author"]) == 1 else " & ".join(p["author"])
-                text += f'<td style="background-color:#99FF99">{names}</td>'
-            else:
-                text += "<td style=\"background-color:#FBA\">Goulo</td>"
-            
-            if p["title"] != None:
-                text += f"<td>{html.escape(p['title'])}</td>"
-            else:
-                text += "<td style=\"background-color:#FBA\">Titl ebet</td>"
-            
-            if p["doctype"]:
-                text += "<td style=\"background-color:#99FF99\">Mat</td>"
-            else:
-                text += "<td style=\"background-color:#FBA\">Kudenn</td>"
-            
-            if p["html_tags"] and p["head_tags"] and p["body_tags"]:
-                text += "<td style=\"background-color:#99FF99\">Mat</td>"
-            else:
-                text += "<td style=\"background-color:#FBA\">Kudenn</td>"
-            
-            text += f"<td>{p['number_p']}</td>"
-            
-            text += f"<td>{p['number_words']}</td>"
-            
-            text += f"<td>{p['number_img']}</td>"
-            
-            text += f"<td>{p['number_a']}</td>"
-            
-            if p['author'] in evezhiadennou:
-                text += f"<td>{html.escape(evezhiadennou.get(p['author']))}</td>"
-        
-        text += "</tr>\n"
+    def request(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._first_request is None:
+                self._first_request = now
+            self._last_request = now
+            # Under the lock, so that it isn't cleared by a rebuild
+            # starting before the event is set
+            self._requested.set()
     
-    text += """
-    </table>
+    def _wait_for_quiet(self):
+        """ Returns False if there is no pending request anymore """
+        while True:
+            with self._lock:
+                if self._first_request is None:
+                    self._requested.clear()
+                    return False
+                now = time.monotonic()
+                remaining = min(self._last_request + self.delay,
+                                self._first_request + self.max_delay) - now
+                if remaining <= 0:
+                    self._first_request = None
+                    self._requested.clear()
+                    return True
+            time.sleep(remaining)
     
-    <script type="application/javascript">
-"""
-    
-    for folder_name in group_names:
-        text += f"""      document.getElementById('upload-link-{folder_name}').href = 'http://' + document.domain + ':{UPLOAD_SERVERS[folder_name]}/';\n"""
+    def run(self):
+        # The connection must be opened by the thread using it
+        catalog = open_catalog(self.catalog_file)
+        while True:
+            self._requested.wait()
+            if not self._wait_for_quiet():
+                continue
+            t0 = time.monotonic()
+            try:
+                update_index_page(catalog=catalog)
+                INDEX_REBUILDS.inc(("ok",))
+            except Exception as e:
+                print("Index update failed:", repr(e))
+                INDEX_REBUILDS.inc(("error",))
+            INDEX_REBUILD_SECONDS.observe(time.monotonic() - t0)
+
+
+def watch_events(interval, depth=2):
+    """
+    Generator yielding once at start, then every time something may have
+    changed under ROOT_FOLDER or in NOTES_FILE.
+    inotify is used if the inotify_simple module is installed, otherwise
+    it yields every `interval` seconds.
+    """
+    try:
+        from inotify_simple import INotify, flags
+    except ImportError:
+        print("inotify_simple not found, polling every {} s".format(interval))
+        while True:
+            yield
+            time.sleep(interval)
     
-    text += """
-      document.getElementById('kaoz-link').href = "http://" + document.domain + ":8100/";
-      
-      function openInNewTab(url) {
-        var win = window.open(url, '_blank');
-        win.focus();
-      }
-    </script>
-  </body>
-</html>
-"""
+    inotify = INotify()
+    mask = (flags.CREATE | flags.DELETE | flags.MODIFY | flags.ATTRIB
+            | flags.MOVED_FROM | flags.MOVED_TO)
+    # Files outside of ROOT_FOLDER that change the index page
+    top_files = (os.path.basename(NOTES_FILE), "prizian_dre_lisead.html", ROOT_FOLDER)
+    top = inotify.add_watch(os.path.dirname(NOTES_FILE) or ".", mask)
+    watched = dict()
     
-    with open("index.html", "w") as f_out:
-        f_out.write(text)
-        print("Index.html file updated")
+    while True:
+        # Group folders may have been created
+        for dirpath, dirnames, _ in walk(ROOT_FOLDER):
+            if len(dirpath.split(os.path.sep)) >= depth:
+                dirnames.clear()
+            if dirpath not in watched.values():
+                watched[inotify.add_watch(dirpath, mask)] = dirpath
+        
+        yield
+        
+        relevant = False
+        while not relevant:
+            # read_delay gathers the events of a burst
+            for event in inotify.read(read_delay=int(interval * 1000)):
+                if event.mask & flags.IGNORED:
+                    watched.pop(event.wd, None)
+                elif event.wd != top or event.name in top_files:
+                    relevant = True
+
+
+def watch(interval=2.0, jobs=1, catalog_file=None):
+    """ Updates the index page whenever a file it depends on changes """
+    catalog = open_catalog(catalog_file)
+    last_state = None
+    for _ in watch_events(interval):
+        snapshot = snapshot_tree(ROOT_FOLDER)
+        try:
+            notes = file_signature(NOTES_FILE)
+        except OSError:
+            notes = None
+        state = (snapshot, notes, os.path.exists("prizian_dre_lisead.html"))
+        if state != last_state:
+            try:
+                update_index_page(jobs, snapshot, catalog=catalog)
+            except Exception as e:
+                # Tried again at the next event (e.g. a file being copied)
+                print("Index update failed:", repr(e))
+            else:
+                last_state = state
+
+
+def open_catalog(filename):
+    """ Returns a catalog.Catalog, or None if filename is None """
+    if filename is None:
+        return None
+    import catalog
+    return catalog.Catalog(filename)
+
+
+def add_catalog_argument(parser):
+    parser.add_argument("--catalog", nargs="?", const=CATALOG_FILE, default=None, metavar="FILE",
+                        help="keep the pages and notes in a SQLite catalog (default file: {})".format(CATALOG_FILE))
 
 
 if __name__ == "__main__":
-    update_index_page()
+    parser = argparse.ArgumentParser(description="Generates the index.html page")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes parsing the pages (0: one per CPU)")
+    parser.add_argument("-w", "--watch", action="store_true", default=False,
+                        help="keep running and update the page when files change")
+    parser.add_argument("--interval", type=float, default=2.0,
+                        help="seconds between two checks in watch mode")
+    parser.add_argument("--no-cache", action="store_true", default=False,
+                        help="parse all the pages, without reading or updating the parse cache "
+                             "or the catalog (with --profile: time the parsing of every page, "
+                             "not only of the modified ones)")
+    add_catalog_argument(parser)
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    
+    if args.watch:
+        if args.profile or args.profile_json:
+            parser.error("--profile can't be used with --watch")
+        if args.no_cache:
+            parser.error("--no-cache can't be used with --watch")
+        try:
+            watch(args.interval, args.jobs, args.catalog)
+        except KeyboardInterrupt:
+            pass
+    elif args.profile or args.profile_json:
+        profiler = profiling.Profiler(args.slowest)
+        update_index_page(jobs=args.jobs, profiler=profiler, catalog=open_catalog(args.catalog),
+                          use_cache=not args.no_cache)
+        profiling.report(profiler, args.profile_json)
+    else:
+        update_index_page(jobs=args.jobs, catalog=open_catalog(args.catalog), use_cache=not args.no_cache)
     